@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from flask import Flask, url_for
 
 from pyaspora.database import db
+from pyaspora.content.uploads import UploadRequest
 from pyaspora.content.views import blueprint as content_blueprint
 from pyaspora.contact.views import blueprint as contacts_blueprint
 from pyaspora.diaspora.views import blueprint as diaspora_blueprint
@@ -13,7 +14,12 @@ from pyaspora.tag.views import blueprint as tags_blueprint
 from pyaspora.user.views import blueprint as users_blueprint
 from pyaspora.utils import templates
 
+# Modules that only provide commands
+import pyaspora.diaspora.delivery
+import pyaspora.diaspora.inbound
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 db.init_app(app)
 
 # Global configuration
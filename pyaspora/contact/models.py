@@ -1,12 +1,13 @@
 from __future__ import absolute_import
 
 from json import dumps
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, event, ForeignKey, Integer, String
 from sqlalchemy.orm import joinedload, relationship
 from sqlalchemy.sql import and_
 
 from pyaspora import db
 from pyaspora.content.models import MimePart
+from pyaspora.utils.keys import forget_public_key
 
 
 class Contact(db.Model):
@@ -47,7 +48,7 @@ class Contact(db.Model):
         Get a contact by primary key ID. None is returned if the Contact
         doesn't exist. If prefetch is true (which it is by default) the
         contact's bio and avatar parts will be pre-fetched, along with any
-        interests.
+        interests and Diaspora details.
         """
         if prefetch:
             res = cls.get_many([contact_id])
@@ -66,7 +67,8 @@ class Contact(db.Model):
             options(
                 joinedload(cls.avatar),
                 joinedload(cls.bio),
-                joinedload(cls.interests)
+                joinedload(cls.interests),
+                joinedload('diasp')
             ). \
             filter(cls.id.in_(contact_ids))
 
@@ -83,6 +85,7 @@ class Contact(db.Model):
             Subscribe.send(self.user, contact)
             Profile.send(self.user, contact)
         self.notify_subscribe(contact)
+        self._refresh_feed_for_author(contact)
 
     def unsubscribe(self, contact):
         """
@@ -98,6 +101,16 @@ class Contact(db.Model):
             db.session.delete(sub)
         if not contact.user:
             Unsubscribe.send(self.user, contact)
+        self._refresh_feed_for_author(contact)
+
+    def _refresh_feed_for_author(self, contact):
+        """
+        After a change in subscription, update the feed of this Contact's
+        User (if local) to add or remove the wall posts of <contact>.
+        """
+        from pyaspora.feed.models import FeedEntry
+        if self.user:
+            FeedEntry.rebuild(user_ids=[self.user.id], author_ids=[contact.id])
 
     def notify_subscribe(self, contact):
         """
@@ -162,3 +175,12 @@ class Contact(db.Model):
         friends = db.session.query(Contact).join(Subscription.from_contact). \
             filter(Subscription.to_contact == self)
         return friends
+
+
+@event.listens_for(Contact.public_key, 'set')
+def _public_key_changed(contact, value, old_value, initiator):
+    """
+    Don't keep the parsed form of a key that has been replaced.
+    """
+    if value != old_value:
+        forget_public_key(contact.id)
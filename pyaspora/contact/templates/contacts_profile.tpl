@@ -61,6 +61,9 @@ Display a contact's "wall", which varies according to who is viewing it.
 
 {% if feed %}
     {{show_feed(feed)}}
+    {% if next %}
+        {{button_form(next, 'Older posts', method='get')}}
+    {% endif %}
 {% else %}
     <p>No news to show.</p>
 {% endif %}
@@ -6,18 +6,21 @@ cached information.
 
 from __future__ import absolute_import
 
-from flask import Blueprint, request, url_for, abort as flask_abort
+from flask import Blueprint, current_app, request, url_for, \
+    abort as flask_abort
 from lxml import etree
 from re import match as re_match
 from sqlalchemy.orm import contains_eager
-from sqlalchemy.sql import desc, or_
+from sqlalchemy.sql import or_
 
 from pyaspora.contact.models import Contact
+from pyaspora.content.images import get_variant_and_commit
 from pyaspora.database import db
 from pyaspora.tag.views import json_tag
 from pyaspora.utils import get_server_name
+from pyaspora.utils.pagination import paginate
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
-    raw_response, redirect, render_response, send_xml
+    CACHE_FOREVER, redirect, render_response, send_part, send_xml
 from pyaspora.user.session import logged_in_user, require_logged_in_user
 
 blueprint = Blueprint('contacts', __name__, template_folder='templates')
@@ -33,7 +36,13 @@ def avatar(contact_id):
     Display the photo (or other media item) that represents a Contact.
     If the user is logged in they can view the avatar for any contact, but
     if not logged in then only locally-mastered contacts have their avatar
-    displayed.
+    displayed. A placeholder is shown while a remote contact's picture is
+    waiting to be downloaded.
+
+    The avatar can change, so is revalidated on each use unless the URL
+    names the current version (as the URLs from json_contact do), in which
+    case it can be cached indefinitely. If the "size" parameter is given the
+    picture is scaled down to fit that many pixels.
     """
     contact = Contact.get(contact_id)
     if not contact:
@@ -42,10 +51,24 @@ def avatar(contact_id):
         abort(404, 'No such contact', force_status=True)
 
     part = contact.avatar
+    if not part and _avatar_pending(contact):
+        response = current_app.send_static_file('nophoto.png')
+        response.cache_control.no_cache = True
+        response.cache_control.max_age = 0
+        return response
     if not part:
         abort(404, 'Contact has no avatar', force_status=True)
 
-    return raw_response(part.body, part.type)
+    current = request.args.get('v') == str(part.id)
+    public = bool(contact.user)
+    size = request.args.get('size', type=int)
+    if size:
+        part = get_variant_and_commit(part, size)
+    return send_part(part, CACHE_FOREVER if current else 0, public)
+
+
+def _avatar_pending(contact):
+    return bool(contact.diasp and contact.diasp.avatar_url)
 
 
 def _profile_base(contact_id, public=False):
@@ -63,7 +86,7 @@ def _profile_base(contact_id, public=False):
     viewing_as = None if public else logged_in_user()
 
     data = json_contact(contact, viewing_as)
-    limit = int(request.args.get('limit', 99))
+    data['next'] = None
 
     # If not local, we don't have a proper feed
     if contact.user:
@@ -75,13 +98,16 @@ def _profile_base(contact_id, public=False):
                 contact, viewing_as)
             feed_query = or_(feed_query, shared_query)
 
-        feed = db.session.query(Share). \
-            join(Post). \
-            filter(feed_query). \
-            order_by(desc(Post.thread_modified_at)). \
-            group_by(Post.id). \
-            options(contains_eager(Share.post)). \
-            limit(limit)
+        feed, data['next'] = paginate(
+            db.session.query(Share).
+            join(Post).
+            filter(feed_query).
+            group_by(Post.id).
+            options(contains_eager(Share.post)),
+            Post.thread_sort_time,
+            Post.id,
+            lambda s: (s.post.thread_sort_time, s.post_id)
+        )
 
         data['feed'] = json_posts([(s.post, s) for s in feed], viewing_as)
 
@@ -178,10 +204,12 @@ def json_contact(contact, viewing_as=None):
         'feed': None,
         'tags': [json_tag(t) for t in contact.interests]
     }
-    if contact.avatar:
+    if contact.avatar or _avatar_pending(contact):
         resp['avatar'] = url_for(
             'contacts.avatar',
             contact_id=contact.id,
+            v=contact.avatar_id,
+            size=300,
             _external=True
         )
 
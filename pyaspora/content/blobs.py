@@ -0,0 +1,186 @@
+"""
+Storage for the bodies of MimeParts outside the database. Bodies are stored
+under the SHA-256 hash of their content, so identical bodies (for example,
+the same picture uploaded twice) are only stored once, and a stored body
+never changes.
+
+The store used is chosen by the BLOB_STORE setting, from the types
+registered with @blob_store_type.
+"""
+from __future__ import absolute_import
+
+from flask import current_app
+from hashlib import sha256
+from os import close, listdir, makedirs, path, remove, rename, utime
+from tempfile import mkstemp
+
+BLOB_STORE_TYPES = {}
+
+CHUNK_SIZE = 64 * 1024
+
+
+def blob_store_type(name):
+    """
+    Decorator which registers a class as a type of blob store that can be
+    chosen with the BLOB_STORE setting. The class is constructed with the
+    app.
+    """
+    def _inner(cls):
+        BLOB_STORE_TYPES[name] = cls
+        return cls
+    return _inner
+
+
+def blob_store():
+    """
+    The blob store configured for the current app.
+    """
+    stores = current_app.extensions.setdefault('pyaspora_blob_stores', {})
+    name = current_app.config.get('BLOB_STORE', 'filesystem')
+    if name not in stores:
+        stores[name] = BLOB_STORE_TYPES[name](current_app)
+    return stores[name]
+
+
+def hash_body(body):
+    """
+    The key under which <body> is stored.
+    """
+    return sha256(body).hexdigest()
+
+
+def _ensure_dir(directory):
+    try:
+        makedirs(directory)
+    except OSError:
+        # Another thread or process may have just created it
+        if not path.isdir(directory):
+            raise
+
+
+@blob_store_type('filesystem')
+class FileSystemBlobStore(object):
+    """
+    Keeps each body in a file under the BLOB_STORE_PATH directory (by
+    default, "blobs" in the app's instance folder), named after its hash.
+    """
+    def __init__(self, app):
+        self.root = app.config.get('BLOB_STORE_PATH') or \
+            path.join(app.instance_path, 'blobs')
+
+    def _path(self, key):
+        assert len(key) == 64 and key.isalnum()
+        return path.join(self.root, key[0:2], key[2:4], key)
+
+    def put(self, body):
+        """
+        Store the bytes <body> and return their key.
+        """
+        key = hash_body(body)
+        if not self._reuse(key):
+            tmp = self._temp_file()
+            with open(tmp, 'wb') as f:
+                f.write(body)
+            self._commit(tmp, key)
+        return key
+
+    def put_file(self, fileobj, key=None):
+        """
+        Store the contents of the open file <fileobj>, copying it in chunks,
+        and return a tuple of their key and size. If the caller already
+        knows the <key> and it's stored, the file isn't read at all.
+        """
+        if key and self._reuse(key):
+            fileobj.seek(0, 2)
+            return key, fileobj.tell()
+
+        fileobj.seek(0)
+        hasher = sha256()
+        size = 0
+        tmp = self._temp_file()
+        try:
+            with open(tmp, 'wb') as f:
+                while True:
+                    chunk = fileobj.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        except Exception:
+            remove(tmp)
+            raise
+        key = hasher.hexdigest()
+        if self._reuse(key):
+            remove(tmp)
+        else:
+            self._commit(tmp, key)
+        return key, size
+
+    def _temp_file(self):
+        _ensure_dir(self.root)
+        fd, tmp = mkstemp(dir=self.root, prefix='.incoming-')
+        close(fd)
+        return tmp
+
+    def _commit(self, tmp, key):
+        # Written to a temporary file first so that a blob is never seen
+        # half-written
+        target = self._path(key)
+        _ensure_dir(path.dirname(target))
+        rename(tmp, target)
+
+    def exists(self, key):
+        return path.exists(self._path(key))
+
+    def _reuse(self, key):
+        # A body stored again counts as newly written, so that keys() doesn't
+        # offer it for deletion before the part using it is saved
+        try:
+            utime(self._path(key), None)
+            return True
+        except OSError:
+            return False
+
+    def keys(self, written_before):
+        """
+        Generate the keys of the stored bodies last written before the time
+        <written_before> (in seconds since the epoch). Temporary files left
+        behind by interrupted writes before then are removed.
+        """
+        if not path.isdir(self.root):
+            return
+        for name in listdir(self.root):
+            full = path.join(self.root, name)
+            if name.startswith('.incoming-'):
+                if path.getmtime(full) < written_before:
+                    remove(full)
+                continue
+            for sub in listdir(full):
+                for key in listdir(path.join(full, sub)):
+                    if path.getmtime(path.join(full, sub, key)) < \
+                            written_before:
+                        yield key
+
+    def delete(self, key):
+        """
+        Remove the body stored under <key>, if there is one.
+        """
+        try:
+            remove(self._path(key))
+        except OSError:
+            pass
+
+    def open(self, key):
+        """
+        Return a file object from which the body stored under <key> can be
+        read.
+        """
+        return open(self._path(key), 'rb')
+
+    def get(self, key):
+        """
+        Return the body stored under <key>.
+        """
+        with self.open(key) as f:
+            return f.read()
@@ -0,0 +1,150 @@
+"""
+Cache of rendered MimeParts. Because MimePart bodies never change once
+created, the output of renderers that depend only on the body can be kept.
+A bounded in-process LRU sits in front of an optional store in the database
+(enabled with the RENDER_CACHE_PERSIST setting).
+"""
+from __future__ import absolute_import
+
+from flask import current_app
+
+from pyaspora.content.models import RenderedPart
+from pyaspora.database import db
+from pyaspora.utils.cache import LRUCache
+
+DEFAULT_SIZE = 1000
+
+# Distinguishes "not cached" from a cached rendering of None
+_MISSING = object()
+
+_memory = None
+_not_stored = LRUCache()  # Keys known to be missing from the database store
+_store_stats = {
+    'hits': 0,
+    'misses': 0,
+}
+
+
+def _memory_cache():
+    global _memory
+    if _memory is None:
+        _memory = LRUCache(
+            current_app.config.get('RENDER_CACHE_SIZE', DEFAULT_SIZE)
+        )
+    return _memory
+
+
+def _persist():
+    return current_app.config.get('RENDER_CACHE_PERSIST', False)
+
+
+def _key(part, fmt):
+    return (part.mime_part.id, fmt, bool(part.inline))
+
+
+def cached_render(part, fmt, render_fn):
+    """
+    Return the rendering of PostPart <part> into format <fmt>, calling
+    <render_fn> to render it if it hasn't been rendered before. Parts that
+    have not been saved yet are never cached.
+    """
+    if part.mime_part.id is None:
+        return render_fn()
+
+    key = _key(part, fmt)
+    memory = _memory_cache()
+    ret = memory.get(key, _MISSING)
+    if ret is not _MISSING:
+        return ret
+
+    if _persist() and not _not_stored.get(key):
+        stored = RenderedPart.get(*key)
+        if stored:
+            _store_stats['hits'] += 1
+            memory.put(key, stored.body)
+            return stored.body
+        _store_stats['misses'] += 1
+
+    ret = render_fn()
+    memory.put(key, ret)
+    return ret
+
+
+def is_cached(part, fmt):
+    """
+    Whether the rendering of PostPart <part> into format <fmt> is in memory,
+    for example after preload().
+    """
+    return part.mime_part.id is not None and \
+        _key(part, fmt) in _memory_cache().entries
+
+
+def preload(parts, fmt):
+    """
+    Fetch any stored renderings of the PostParts <parts> into format <fmt>
+    that aren't already in memory, using one query.
+    """
+    if not _persist():
+        return
+
+    memory = _memory_cache()
+    wanted = set(
+        _key(p, fmt) for p in parts
+        if p.mime_part.id is not None and _key(p, fmt) not in memory.entries
+    )
+    if not wanted:
+        return
+
+    stored_parts = db.session.query(RenderedPart).filter(
+        RenderedPart.mime_part_id.in_(set(k[0] for k in wanted)),
+        RenderedPart.format == fmt
+    )
+    for stored in stored_parts:
+        key = (stored.mime_part_id, stored.format, stored.inline)
+        if key in wanted:
+            _store_stats['hits'] += 1
+            memory.put(key, stored.body)
+            wanted.remove(key)
+    for key in wanted:
+        _store_stats['misses'] += 1
+        _not_stored.put(key, True)
+
+
+def store_render(part, fmt, rendered):
+    """
+    Record the rendering <rendered> of PostPart <part> into format <fmt>, in
+    memory and (if enabled) the database. The caller must commit the session.
+    """
+    key = _key(part, fmt)
+    _memory_cache().put(key, rendered)
+    if _persist() and not RenderedPart.get(*key):
+        db.session.add(RenderedPart(
+            mime_part_id=key[0],
+            format=key[1],
+            inline=key[2],
+            body=rendered
+        ))
+
+
+def clear():
+    """
+    Discard all cached renderings, for example because a renderer changed.
+    The caller must commit the session.
+    """
+    _memory_cache().clear()
+    db.session.query(RenderedPart).delete(synchronize_session=False)
+
+
+def stats():
+    """
+    Hit/miss counters for the in-process cache and the database store.
+    """
+    memory = _memory_cache()
+    return {
+        'memory': {
+            'hits': memory.hits,
+            'misses': memory.misses,
+            'size': len(memory.entries),
+        },
+        'store': dict(_store_stats),
+    }
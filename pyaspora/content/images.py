@@ -0,0 +1,124 @@
+"""
+Smaller copies ("variants") of pictures, so that a page showing a picture
+at a small size doesn't have to download it at full size. Variants come in
+a few fixed sizes, and are stored as MimeParts like any other content, so
+they are made once and then served (and cached) like the original.
+
+Pictures are resized with Pillow. If it isn't installed the original is
+always used.
+"""
+from __future__ import absolute_import
+
+from contextlib import closing
+from flask import current_app
+from io import BytesIO
+from sqlalchemy.exc import IntegrityError
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from pyaspora.content.models import ImageVariant, MimePart
+from pyaspora.database import db
+
+# The largest width or height of each variant, in pixels
+VARIANT_SIZES = (50, 100, 300, 800)
+
+# Sizes in which remote and local users' pictures are shown
+AVATAR_SIZES = (50, 100, 300)
+
+# Pictures are shown in feeds no bigger than this
+FEED_SIZE = 800
+
+# Pillow's name for each type of picture that can be resized
+RESIZABLE_TYPES = {
+    'image/jpeg': 'JPEG',
+    'image/png': 'PNG',
+}
+
+
+def fitting_size(size):
+    """
+    The size of the smallest variant that is at least <size> pixels, or None
+    if the original should be used.
+    """
+    for variant_size in VARIANT_SIZES:
+        if size <= variant_size:
+            return variant_size
+    return None
+
+
+def get_variant(part, size):
+    """
+    Return the MimePart to show for the picture <part> when it's to be shown
+    at most <size> pixels wide and high, making the variant if it doesn't
+    exist yet. The caller must commit the session.
+    """
+    size = fitting_size(size)
+    if not size or not Image or part.type not in RESIZABLE_TYPES:
+        return part
+    existing = ImageVariant.get(part.id, size)
+    if existing:
+        return existing.variant
+
+    variant = ImageVariant(
+        original_id=part.id,
+        max_size=size,
+        variant=_resize(part, size) or part
+    )
+    db.session.add(variant)
+    return variant.variant
+
+
+def get_variant_and_commit(part, size):
+    """
+    As get_variant(), but saves a new variant straight away. This is for use
+    by views, which may race to make the same variant.
+    """
+    part_id = part.id
+    variant = get_variant(part, size)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        variant = ImageVariant.get(part_id, fitting_size(size)).variant
+    return variant
+
+
+def make_variants(part, sizes=AVATAR_SIZES):
+    """
+    Make the variants of <part> in the given <sizes> ahead of them being
+    asked for, for example when a picture is uploaded. The part must have
+    been saved (flushed). The caller must commit the session.
+    """
+    for size in sizes:
+        get_variant(part, size)
+
+
+def _resize(part, size):
+    """
+    Return a new MimePart holding <part> scaled to fit <size> pixels, or
+    None if it's already small enough or can't be read.
+    """
+    try:
+        with closing(part.open_body()) as f:
+            image = Image.open(f)
+            if max(image.size) <= size:
+                return None
+            image.thumbnail((size, size), Image.LANCZOS)
+    except Exception as e:
+        # Including Pillow's DecompressionBombError for huge images
+        current_app.logger.warning(
+            'Could not resize part {0}: {1}'.format(part.id, e))
+        return None
+
+    image_format = RESIZABLE_TYPES[part.type]
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    out = BytesIO()
+    image.save(out, image_format, optimize=True)
+    return MimePart(
+        type=part.type,
+        body=out.getvalue(),
+        text_preview=part.text_preview
+    )
@@ -1,27 +1,82 @@
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
-from sqlalchemy import Column, Integer, LargeBinary, String
+from io import BytesIO
+from itertools import islice
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, \
+    LargeBinary, String, Text
+from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.sql.expression import func
+from sqlalchemy.orm.attributes import set_committed_value
+from time import time
 
+from pyaspora.content.blobs import blob_store
 from pyaspora.database import db
+from pyaspora.utils.commands import command
+
 
 
 class MimePart(db.Model):
     """
     A piece of content (eg. text, HTML, image, video) that forms part of a
-    Post.
+    Post. Only the metadata is loaded with the part; the body is fetched
+    when it's used.
 
     Fields:
         id - an integer identifier uniquely identifying this group in the node
         type - the MIME type (eg. "text/plain") of the body
-        body - the raw content blob
+        body - the raw content blob. This is kept in the blob store, not the
+               database, and read from it when used
+        body_hash - the key of the body in the blob store
+        size - the length of the body, in bytes
         text_preview - plain text that can be displayed in lieu of content if
                        the body cannot be displayed
+        created_at - when the part was stored; the body never changes after
     """
     __tablename__ = 'mime_parts'
     id = Column(Integer, primary_key=True)
     type = Column(String, nullable=False)
-    body = Column(LargeBinary, nullable=False)
+    # Bodies stored before the blob store existed, until migrate_blobs is run
+    _body = deferred(Column('body', LargeBinary, nullable=True))
+    body_hash = Column(String(64), nullable=True, index=True)
+    size = Column(Integer, nullable=True)
     text_preview = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), nullable=True,
+                        default=func.now())
+
+    @property
+    def body(self):
+        if self.body_hash:
+            return blob_store().get(self.body_hash)
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self.body_hash = blob_store().put(body)
+        self.size = len(body)
+        self._body = None
+
+    def set_body_file(self, fileobj, body_hash=None):
+        """
+        Set the body to the contents of the open file <fileobj>, without
+        reading it all into memory. <body_hash> may be given if the hash of
+        the contents is already known.
+        """
+        self.body_hash, self.size = blob_store().put_file(fileobj, body_hash)
+        self._body = None
+
+    def open_body(self):
+        """
+        Return a file object from which the body can be read, so that it
+        needn't be held in memory all at once.
+        """
+        if self.body_hash:
+            return blob_store().open(self.body_hash)
+        return BytesIO(self._body)
+
+    def body_size(self):
+        if self.size is None:
+            self.size = len(self._body)
+        return self.size
 
     @classmethod
     def get(cls, part_id):
@@ -30,3 +85,125 @@ class MimePart(db.Model):
         doesn't exist.
         """
         return db.session.query(cls).get(part_id)
+
+    @classmethod
+    def load_bodies(cls, parts):
+        """
+        Fetch the bodies of any of the MimeParts <parts> that are still kept
+        in the database and haven't been loaded yet, using one query.
+        """
+        wanted = dict(
+            (p.id, p) for p in parts
+            if p.id is not None and not p.body_hash and
+            '_body' not in p.__dict__
+        )
+        if not wanted:
+            return
+        bodies = db.session.query(cls.id, cls._body). \
+            filter(cls.id.in_(wanted.keys()))
+        for part_id, body in bodies:
+            set_committed_value(wanted[part_id], '_body', body)
+
+
+class ImageVariant(db.Model):
+    """
+    A smaller copy of a picture, for showing it at a fixed size without
+    downloading it at full size. See pyaspora.content.images.
+
+    Fields:
+        original_id - the MimePart holding the picture
+        max_size - the largest width or height of the copy, in pixels
+        variant - the MimePart holding the copy. This is the original itself
+                  if it was already small enough, or couldn't be resized
+        variant_id - the database primary key for the above
+    """
+    __tablename__ = 'image_variants'
+    original_id = Column(Integer, ForeignKey('mime_parts.id'),
+                         primary_key=True)
+    max_size = Column(Integer, primary_key=True)
+    variant_id = Column(Integer, ForeignKey('mime_parts.id'), nullable=False)
+
+    variant = relationship(MimePart, foreign_keys=[variant_id])
+
+    @classmethod
+    def get(cls, original_id, max_size):
+        """
+        Get the variant of a MimePart. None is returned if it hasn't been
+        made.
+        """
+        return db.session.query(cls).get((original_id, max_size))
+
+
+class RenderedPart(db.Model):
+    """
+    The output of rendering a MimePart into a display format. MimePart bodies
+    never change, so this can be kept indefinitely.
+
+    Fields:
+        mime_part_id - the MimePart that was rendered
+        format - the MIME type it was rendered to (eg. "text/html")
+        inline - whether the part was rendered for display inline
+        body - the rendered output, or None if the renderer had no output
+    """
+    __tablename__ = 'rendered_parts'
+    mime_part_id = Column(Integer, ForeignKey('mime_parts.id'),
+                          primary_key=True)
+    format = Column(String, primary_key=True)
+    inline = Column(Boolean, primary_key=True)
+    body = Column(Text, nullable=True)
+
+    @classmethod
+    def get(cls, mime_part_id, fmt, inline):
+        """
+        Get a stored rendering. None is returned if there isn't one.
+        """
+        return db.session.query(cls).get((mime_part_id, fmt, inline))
+
+
+@command('sweep_blobs')
+def sweep_blobs(grace_hours='24', batch_size='500'):
+    """
+    Delete bodies in the blob store that no MimePart uses, such as those
+    stored for an upload that was then refused, or a request that failed.
+    Bodies written in the last <grace_hours> hours are kept, as the parts
+    using them may not have been saved yet.
+    """
+    store = blob_store()
+    keys = store.keys(time() - float(grace_hours) * 60 * 60)
+    batch_size = int(batch_size)
+    checked = removed = 0
+    while True:
+        batch = set(islice(keys, batch_size))
+        if not batch:
+            break
+        checked += len(batch)
+        used = set(r[0] for r in db.session.query(MimePart.body_hash).
+                   filter(MimePart.body_hash.in_(batch)))
+        for key in batch - used:
+            store.delete(key)
+            removed += 1
+    db.session.rollback()
+    print('Removed {0} of {1} bodies checked'.format(removed, checked))
+
+
+@command('migrate_blobs')
+def migrate_blobs(batch_size='100'):
+    """
+    Move the bodies of MimeParts stored in the database into the blob store.
+    Identical bodies are only stored once.
+    """
+    moved = 0
+    keys = set()
+    while True:
+        parts = db.session.query(MimePart). \
+            filter(MimePart._body != None). \
+            order_by(MimePart.id).limit(int(batch_size)).all()
+        if not parts:
+            break
+        for part in parts:
+            part.body = part._body
+            keys.add(part.body_hash)
+        db.session.commit()
+        db.session.expunge_all()
+        moved += len(parts)
+    print('Moved {0} bodies, stored as {1} blobs'.format(moved, len(keys)))
@@ -1,22 +1,89 @@
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
-from flask import render_template_string, url_for
+from flask import current_app, render_template_string, url_for
 from json import loads
 from markdown import markdown
+from sqlalchemy.orm import contains_eager
+from time import time
 
+from pyaspora.content import cache
+from pyaspora.database import db
+from pyaspora.utils.commands import command
 from pyaspora.utils.rendering import ACCEPTABLE_BROWSER_IMAGE_FORMATS
 
 renderers = {}
+cacheable_formats = set()
+body_formats = set()
 
 
-def renderer(formats):
+class PrecompiledTemplate(object):
+    """
+    A template held as a string, which is compiled once per Jinja environment
+    on first use rather than on every render (as render_template_string()
+    does).
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.compiled = {}
+
+    def render(self, **context):
+        env = current_app.jinja_env
+        template = self.compiled.get(env, None)
+        if template is None:
+            template = self.compiled[env] = env.from_string(self.source)
+        return template.render(**context)
+
+
+templates = dict((name, PrecompiledTemplate(source)) for name, source in {
+    'text_plain': '{{text|nl2br}}',
+    'common_images': '<a href="{{full}}"><img src="{{url}}" alt="{{alt}}" />'
+                     '</a>',
+    'pyaspora_subscribe': 'subscribed to <a href="{{profile}}">{{name}}</a>',
+    'pyaspora_share': "shared <a href='{{profile}}'>{{name}}</a>'s post",
+    'default_preview': '{{t}}',
+    'default_html_link': '<a href="{{u}}">(link)</a>',
+    'default_text_link': 'Link: {{u}}',
+    'diaspora_profile': """
+    <p>{{bio or '(no info)'}}</p>
+    <table>
+        {%- if gender %}
+        <tr>
+            <th>Gender</th>
+            <td>{{gender}}</td>
+        </tr>
+        {% endif -%}
+        {%- if birthday %}
+        <tr>
+            <th>Birthday</th>
+            <td>{{birthday}}</td>
+        </tr>
+        {% endif -%}
+        {%- if location %}
+        <tr>
+            <th>Location</th>
+            <td>{{location}}</td>
+        </tr>
+        {% endif -%}
+    </table>
+    """,
+}.items())
+
+
+def renderer(formats, cacheable=False, reads_body=True):
     """
     Decorator which remembers the functions and the MIME types that they
-    will render.
+    will render. If <cacheable> is true the output depends only on the part
+    body and inline flag, so can be cached. If <reads_body> is false the
+    renderer only uses the part's metadata, so the body needn't be fetched.
     """
     def stash_format(f):
         for fmt in formats:
             renderers[fmt] = f
+            if cacheable:
+                cacheable_formats.add(fmt)
+            if reads_body:
+                body_formats.add(fmt)
         return f
     return stash_format
 
@@ -29,15 +96,14 @@ def renderer_exists(fmt):
     return renderers.get(fmt, None)
 
 
-@renderer(['text/plain'])
+@renderer(['text/plain'], cacheable=True)
 def text_plain(part, fmt, url):
     """
     Renderer for text/plain.
     """
     if part.inline:
         if fmt == 'text/html':
-            return render_template_string(
-                '{{text|nl2br}}',
+            return templates['text_plain'].render(
                 text=part.mime_part.body.decode('utf-8')
             )
         if fmt == 'text/plain':
@@ -45,7 +111,7 @@ def text_plain(part, fmt, url):
     return None
 
 
-@renderer(['text/html'])
+@renderer(['text/html'], cacheable=True)
 def text_html(part, fmt, url):
     """
     Renderer for text/html.
@@ -55,7 +121,7 @@ def text_html(part, fmt, url):
     return None
 
 
-@renderer(['text/x-markdown'])
+@renderer(['text/x-markdown'], cacheable=True)
 def text_markdown(part, fmt, url):
     """
     Renderer for text/x-markdown (MarkDown).
@@ -82,15 +148,22 @@ def text_markdown(part, fmt, url):
     return None
 
 
-@renderer(ACCEPTABLE_BROWSER_IMAGE_FORMATS)
+@renderer(ACCEPTABLE_BROWSER_IMAGE_FORMATS, reads_body=False)
 def common_images(part, fmt, url):
     """
-    Renderer for image/* that a browser can display in an <img> tag.
+    Renderer for image/* that a browser can display in an <img> tag. The
+    picture is shown scaled down, linking to the full size.
     """
+    from pyaspora.content.images import FEED_SIZE
     if fmt == 'text/html' and part.inline:
-        return render_template_string(
-            '<img src="{{url}}" alt="{{alt}}" />',
+        return templates['common_images'].render(
             url=url_for(
+                'content.raw',
+                part_id=part.mime_part.id,
+                size=FEED_SIZE,
+                _external=True
+            ),
+            full=url_for(
                 'content.raw',
                 part_id=part.mime_part.id,
                 _external=True
@@ -110,8 +183,7 @@ def pyaspora_subscribe(part, fmt, url):
 
     payload = loads(part.mime_part.body.decode('utf-8'))
     to_contact = Contact.get(payload['to'])
-    return render_template_string(
-        'subscribed to <a href="{{profile}}">{{name}}</a>',
+    return templates['pyaspora_subscribe'].render(
         profile=url_for(
             'contacts.profile',
             contact_id=to_contact.id,
@@ -131,8 +203,7 @@ def pyaspora_share(part, fmt, url):
 
     payload = loads(part.mime_part.body.decode('utf-8'))
     author = payload['author']
-    return render_template_string(
-        "shared <a href='{{profile}}'>{{name}}</a>'s post",
+    return templates['pyaspora_share'].render(
         profile=url_for(
             'contacts.profile',
             contact_id=author['id'],
@@ -154,21 +225,24 @@ def render(part, fmt, url=None):
     ret = None
     renderer = renderer_exists(part.mime_part.type)
     if renderer:
-        ret = renderer(part, fmt, url)
+        if part.mime_part.type in cacheable_formats:
+            ret = cache.cached_render(
+                part, fmt, lambda: renderer(part, fmt, url))
+        else:
+            ret = renderer(part, fmt, url)
 
     if ret is not None:  # might be empty string!
         return ret
 
     defaults = {
         'text/html': {
-            True: lambda p: render_template_string(
-                '{{t}}', t=p.mime_part.text_preview),
-            False: lambda p: render_template_string(
-                '<a href="{{u}}">(link)</a>', u=url),
+            True: lambda p: templates['default_preview'].render(
+                t=p.mime_part.text_preview),
+            False: lambda p: templates['default_html_link'].render(u=url),
         },
         'text/plain': {
             True: lambda p: p.mime_part.text_preview,
-            False: lambda p: render_template_string('Link: {{u}}', u=url),
+            False: lambda p: templates['default_text_link'].render(u=url),
         }
     }
 
@@ -179,6 +253,112 @@ def render(part, fmt, url=None):
     return None
 
 
+def render_many(parts, fmt, urls=None):
+    """
+    Render each of the PostParts in the list <parts> into MIME format <fmt>,
+    as render() does. <urls> is an optional list of URLs corresponding to
+    the parts. Cached renderings for the whole list are fetched together,
+    as are the bodies of the inline parts that still need rendering.
+    """
+    from pyaspora.content.models import MimePart
+    parts = list(parts)
+    cache.preload([p for p in parts if p.mime_part.type in cacheable_formats],
+                  fmt)
+    MimePart.load_bodies([
+        p.mime_part for p in parts
+        if p.inline and p.mime_part.type in body_formats and
+        not cache.is_cached(p, fmt)
+    ])
+    return [
+        render(part, fmt, urls[i] if urls else None)
+        for i, part in enumerate(parts)
+    ]
+
+
+def prerender(parts):
+    """
+    Fill the render cache for the PostParts <parts>. This is done when a
+    Post is created or received so that feeds don't have to render new
+    parts. Pending changes are flushed first, so that the parts have IDs.
+    The caller must commit the session.
+    """
+    db.session.flush()
+    for part in parts:
+        if part.mime_part.type not in cacheable_formats:
+            continue
+        renderer = renderer_exists(part.mime_part.type)
+        for fmt in ('text/plain', 'text/html'):
+            cache.store_render(part, fmt, renderer(part, fmt, None))
+
+
+@command('rebuild_render_cache')
+def rebuild_render_cache():
+    """
+    Discard the stored renderings and re-render every cacheable part.
+    """
+    from pyaspora.content.models import MimePart
+    from pyaspora.post.models import PostPart
+    cache.clear()
+    prerender(
+        db.session.query(PostPart).
+        join(MimePart).
+        filter(MimePart.type.in_(cacheable_formats)).
+        options(contains_eager(PostPart.mime_part))
+    )
+    db.session.commit()
+    print('Render cache: {0}'.format(cache.stats()))
+
+
+@command('benchmark_render')
+def benchmark_render(iterations='1000', parts='100'):
+    """
+    Time rendering each of the renderers' templates <iterations> times,
+    compiling them each time (as render_template_string() does) and using
+    the precompiled templates. Then time rendering the newest <parts> post
+    parts one at a time and with render_many(), with nothing in the
+    in-memory render cache.
+    """
+    from pyaspora.post.models import PostPart
+    iterations = int(iterations)
+    sample = {
+        'text': 'Some text\nover two lines', 'url': 'http://localhost/1',
+        'full': 'http://localhost/2', 'alt': 'A picture',
+        'profile': 'http://localhost/3', 'name': 'A Name', 't': 'Preview',
+        'u': 'http://localhost/4', 'bio': 'About me', 'gender': 'Unknown',
+        'birthday': '1 January', 'location': 'Somewhere',
+    }
+    for name, template in sorted(templates.items()):
+        start = time()
+        for i in range(iterations):
+            render_template_string(template.source, **sample)
+        compiled = time() - start
+        start = time()
+        for i in range(iterations):
+            template.render(**sample)
+        precompiled = time() - start
+        print('{0}: {1:.1f}us compiling each time, {2:.1f}us '
+              'precompiled'.format(name, compiled * 1e6 / iterations,
+                                   precompiled * 1e6 / iterations))
+
+    page = db.session.query(PostPart). \
+        order_by(PostPart.post_id.desc(), PostPart.order). \
+        limit(int(parts)).all()
+    if not page:
+        print('No post parts to render')
+        return
+    render_many(page, 'text/html')  # Warm up, eg. importing extensions
+    for label, render_page in (
+        ('one at a time', lambda: [render(p, 'text/html') for p in page]),
+        ('render_many', lambda: render_many(page, 'text/html')),
+    ):
+        cache._memory_cache().clear()
+        db.session.expire_all()
+        start = time()
+        render_page()
+        print('{0} parts {1}: {2:.1f}ms'.format(
+            len(page), label, (time() - start) * 1e3))
+
+
 @renderer(['application/x-pyaspora-diaspora-profile'])
 def diaspora_profile(part, fmt, url):
     """
@@ -189,27 +369,4 @@ def diaspora_profile(part, fmt, url):
     if fmt != 'text/html' or not part.inline:
         return None
 
-    templ = """
-    <p>{{bio or '(no info)'}}</p>
-    <table>
-        {%- if gender %}
-        <tr>
-            <th>Gender</th>
-            <td>{{gender}}</td>
-        </tr>
-        {% endif -%}
-        {%- if birthday %}
-        <tr>
-            <th>Birthday</th>
-            <td>{{birthday}}</td>
-        </tr>
-        {% endif -%}
-        {%- if location %}
-        <tr>
-            <th>Location</th>
-            <td>{{location}}</td>
-        </tr>
-        {% endif -%}
-    </table>
-    """
-    return render_template_string(templ, **payload)
+    return templates['diaspora_profile'].render(**payload)
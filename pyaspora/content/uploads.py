@@ -0,0 +1,118 @@
+"""
+Handling of uploaded files. Rather than reading an upload into memory and
+then processing it, each file is spooled as it arrives (in memory while
+small, then in a temporary file in UPLOAD_FOLDER), with its hash, size and
+type worked out along the way, and then copied into the blob store in
+chunks.
+"""
+from __future__ import absolute_import
+
+from flask import current_app, Request
+from hashlib import sha256
+from tempfile import SpooledTemporaryFile
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from pyaspora.content.models import MimePart
+
+# Uploads smaller than this are kept in memory
+SPOOL_MEMORY_BYTES = 512 * 1024
+
+# How much of the start of a file is kept to work out its type
+SNIFF_BYTES = 16
+
+# The types that can be recognised by how the file starts
+SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+)
+
+
+def sniff_type(head):
+    """
+    The MIME type of a file starting with the bytes <head>, or None if it
+    isn't recognised.
+    """
+    for signature, mime_type in SIGNATURES:
+        if head.startswith(signature):
+            return mime_type
+    return None
+
+
+class UploadSpool(object):
+    """
+    A file-like object to which one uploaded file is written as it arrives.
+    An upload larger than <max_bytes> is refused as soon as it gets too big.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.file = SpooledTemporaryFile(SPOOL_MEMORY_BYTES, dir=directory)
+        self.max_bytes = max_bytes
+        self.hasher = sha256()
+        self.size = 0
+        self.head = b''
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def body_hash(self):
+        return self.hasher.hexdigest()
+
+    def sniffed_type(self):
+        return sniff_type(self.head)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+
+class UploadRequest(Request):
+    """
+    Request that spools uploaded files with UploadSpool.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        config = current_app.config
+        return UploadSpool(
+            config.get('UPLOAD_FOLDER'),
+            config.get('UPLOAD_MAX_BYTES', config.get('MAX_CONTENT_LENGTH'))
+        )
+
+
+def upload_type(upload):
+    """
+    The MIME type of the uploaded file <upload> (a FileStorage), worked out
+    from the file itself where possible, rather than trusting the browser.
+    This can be checked before the file is stored.
+    """
+    spool = upload.stream
+    if isinstance(spool, UploadSpool):
+        return spool.sniffed_type() or upload.mimetype
+    head = spool.read(SNIFF_BYTES)
+    spool.seek(0)
+    return sniff_type(head) or upload.mimetype
+
+
+def part_from_upload(upload):
+    """
+    Make a MimePart from the uploaded file <upload> (a FileStorage), copying
+    it into the blob store in chunks. The type is as upload_type() gives.
+    """
+    spool = upload.stream
+    part = MimePart(text_preview=upload.filename, type=upload_type(upload))
+    if isinstance(spool, UploadSpool):
+        part.set_body_file(spool, spool.body_hash())
+    else:
+        part.set_body_file(spool)
+    return part
@@ -1,10 +1,11 @@
 from __future__ import absolute_import
 
-from flask import Blueprint
+from flask import Blueprint, request
 
+from pyaspora.content.images import get_variant_and_commit
 from pyaspora.content.models import MimePart
 from pyaspora.user.session import logged_in_user
-from pyaspora.utils.rendering import abort, raw_response
+from pyaspora.utils.rendering import abort, CACHE_FOREVER, send_part
 
 blueprint = Blueprint('content', __name__, template_folder='templates')
 
@@ -13,6 +14,9 @@ blueprint = Blueprint('content', __name__, template_folder='templates')
 def raw(part_id):
     """
     Return the part's body as a raw byte-stream for eg. serving images.
+    Parts never change, so may be cached indefinitely; parts that aren't
+    public are only cached by the browser. If the "size" parameter is given
+    a picture is scaled down to fit that many pixels.
     """
     part = MimePart.get(part_id)
     logged_in = logged_in_user()
@@ -23,6 +27,10 @@ def raw(part_id):
     # it.
     for link in part.posts:
         if link.post.has_permission_to_view(logged_in):
-            return raw_response(part.body, part.type)
+            public = not logged_in or link.post.has_permission_to_view(None)
+            size = request.args.get('size', type=int)
+            if size:
+                part = get_variant_and_commit(part, size)
+            return send_part(part, CACHE_FOREVER, public)
 
     abort(403, 'Forbidden')
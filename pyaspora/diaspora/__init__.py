@@ -8,9 +8,26 @@ except:
 from pyaspora.content.models import MimePart
 
 
-def import_url_as_mimepart(url):
-    resp = urlopen(url)
+def fetch_url(url, max_bytes=None, timeout=30):
+    """
+    Fetch <url> and return a tuple of its MIME type and body. If <max_bytes>
+    is given, a ValueError is raised rather than reading a larger body.
+    """
+    resp = urlopen(url, timeout=timeout)
+    try:
+        if max_bytes is None:
+            body = resp.read()
+        else:
+            body = resp.read(max_bytes + 1)
+            if len(body) > max_bytes:
+                raise ValueError(
+                    '{0} is larger than {1} bytes'.format(url, max_bytes))
+        return resp.info().get('Content-Type'), body
+    finally:
+        resp.close()
+
+
+def import_url_as_mimepart(url, max_bytes=None):
     mp = MimePart()
-    mp.type = resp.info().get('Content-Type')
-    mp.body = resp.read()
+    mp.type, mp.body = fetch_url(url, max_bytes)
     return mp
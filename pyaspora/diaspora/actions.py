@@ -1,15 +1,16 @@
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
 from base64 import b64encode, b64decode
 from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5 as PKCSSign
 from datetime import datetime
 from dateutil.tz import tzutc
 from flask import current_app, url_for
 from json import dumps
+from logging import DEBUG
 from lxml import etree
 from re import compile as re_compile
+from time import time
 try:
     from urllib.parse import urljoin
     from urllib.request import urlopen
@@ -19,41 +20,84 @@ except:
 
 from pyaspora import db
 from pyaspora.content.models import MimePart
-from pyaspora.diaspora import import_url_as_mimepart
-from pyaspora.diaspora.models import DiasporaContact, DiasporaPost
-from pyaspora.diaspora.protocol import DiasporaMessageBuilder
+from pyaspora.content.rendering import prerender
+from pyaspora.diaspora.models import DiasporaContact, DiasporaPost, \
+    MessageQueue
+from pyaspora.diaspora.protocol import DiasporaMessageBuilder, parse_xml
 from pyaspora.post.models import Post
 from pyaspora.tag.models import Tag
+from pyaspora.utils.commands import command
+from pyaspora.utils.keys import public_key_for
 from pyaspora.utils.rendering import ensure_timezone
 
 HANDLERS = {}
 
+# Handlers indexed by the tag of the message element (/XML/post/<tag>). Most
+# message types are identified by the tag alone; those that also need to
+# look inside the message have a list of compiled XPaths to try.
+HANDLERS_BY_TAG = {}
+HANDLER_XPATHS_BY_TAG = {}
+
+HANDLER_XPATH = re_compile(r'^/XML/post/([\w-]+)(.*)$')
+
 
 def diaspora_message_handler(xpath):
     """
     Decorator which registers a handler to handle messages from the D* netork,
-    selected if the incoming messages matches <xpath>.
+    selected if the incoming messages matches <xpath>, which must be of the
+    form "/XML/post/<tag>" optionally followed by a further path/predicate.
     """
+    match = HANDLER_XPATH.match(xpath)
+    assert match, 'Unsupported handler XPath: ' + xpath
+    tag, rest = match.groups()
+
     def _inner(cls):
         HANDLERS[xpath] = cls
+        if rest:
+            HANDLER_XPATHS_BY_TAG.setdefault(tag, []).append(
+                (etree.XPath(xpath), cls)
+            )
+        else:
+            HANDLERS_BY_TAG[tag] = cls
         return cls
     return _inner
 
 
+def find_handler(doc):
+    """
+    Return the handler for the message in the parsed payload <doc>, or None
+    if there isn't one.
+    """
+    if doc.tag != 'XML':
+        return None
+    for post in doc:
+        if post.tag != 'post':
+            continue
+        for message in post:
+            handler = HANDLERS_BY_TAG.get(message.tag, None)
+            if handler:
+                return handler
+            for xpath, handler in HANDLER_XPATHS_BY_TAG.get(message.tag, []):
+                if xpath(doc):
+                    return handler
+    return None
+
+
 def process_incoming_message(payload, c_from, u_to):
     """
     Decide which type of message this is, and call the correct handler.
     """
     xml = payload.lstrip()
-    current_app.logger.debug(
-        "Message received from {0} for {1}\n{2}".format(
-            c_from.id, u_to.id if u_to else '(none)', xml
+    if current_app.logger.isEnabledFor(DEBUG):
+        current_app.logger.debug(
+            "Message received from {0} for {1}\n{2}".format(
+                c_from.id, u_to.id if u_to else '(none)', xml
+            )
         )
-    )
-    doc = etree.fromstring(xml)
-    for xpath, handler in HANDLERS.items():
-        if doc.xpath(xpath):
-            return handler.receive(doc, c_from, u_to)
+    doc = parse_xml(xml)
+    handler = find_handler(doc)
+    if handler:
+        return handler.receive(doc, c_from, u_to)
     raise Exception("No handler registered", payload)
 
 
@@ -76,32 +120,61 @@ class MessageHandlerBase:
     @classmethod
     def send(cls, u_from, c_to, **kwargs):
         """
-        Send a message from <u_from> to <c_to>.
+        Queue a message from <u_from> to <c_to> for delivery. The caller must
+        commit the session.
         """
         m = cls._build(u_from, c_to, **kwargs)
         url = "{0}receive/users/{1}".format(
             c_to.diasp.server, c_to.diasp.guid)
-        current_app.logger.debug("posting {0} to {1}".format(
+        current_app.logger.debug("queueing {0} to {1}".format(
             etree.tostring(m.message),
             url
         ))
-        resp = m.post(url, RSA.importKey(c_to.public_key))
-        return resp
+        return MessageQueue.queue_outgoing(
+            u_from, c_to, url,
+            m.post_body(public_key_for(c_to))
+        )
+
+    @classmethod
+    def send_many(cls, u_from, targets, **kwargs):
+        """
+        Queue the same message from <u_from> to each of the Contacts in
+        <targets>. The message is built, encrypted and signed once, so this
+        can only be used for messages that don't depend on the recipient.
+        The caller must commit the session.
+        """
+        targets = list(targets)
+        if not targets:
+            return []
+        m = cls._build(u_from, targets[0], **kwargs)
+        urls = [
+            "{0}receive/users/{1}".format(c.diasp.server, c.diasp.guid)
+            for c in targets
+        ]
+        current_app.logger.debug("queueing {0} to {1}".format(
+            etree.tostring(m.message),
+            ', '.join(urls)
+        ))
+        bodies = m.post_bodies(public_key_for(c) for c in targets)
+        return [
+            MessageQueue.queue_outgoing(u_from, c_to, url, body)
+            for c_to, url, body in zip(targets, urls, bodies)
+        ]
 
     @classmethod
     def send_public(cls, u_from, c_to, **kwargs):
         """
-        Send a message from <u_from> to the remote server that <c_to> is on,
-        as a public message.
+        Queue a message from <u_from> to the remote server that <c_to> is on,
+        as a public message. The caller must commit the session.
         """
         m = cls._build(u_from, None, **kwargs)
         url = "{0}receive/public".format(c_to.diasp.server)
-        current_app.logger.debug("posting {0} to {1}".format(
+        current_app.logger.debug("queueing {0} to {1}".format(
             etree.tostring(m.message),
             url
         ))
-        resp = m.post(url, None)
-        return resp
+        return MessageQueue.queue_outgoing(
+            u_from, c_to, url, m.post_body(None))
 
     @classmethod
     def struct_to_xml(cls, node, struct):
@@ -168,7 +241,7 @@ class SignableMixin:
         ])
         signature = b64decode(signature)
         sig_hash = SHA256.new(sig_contents.encode("utf-8"))
-        cipher = PKCSSign.new(RSA.importKey(contact.public_key))
+        cipher = PKCSSign.new(public_key_for(contact))
         return cipher.verify(sig_hash, signature)
 
 
@@ -240,13 +313,12 @@ class Profile(TagMixin, MessageHandlerBase):
             type='application/x-pyaspora-diaspora-profile'
         )
         if 'image_url' in data:
-            mp = import_url_as_mimepart(urljoin(
+            c_from.diasp.set_avatar_url(urljoin(
                 c_from.diasp.server,
                 data['image_url']
             ))
-            mp.text_preview = '(picture for {0})'.format(c_from.realname)
-            c_from.avatar = mp
         else:
+            c_from.diasp.set_avatar_url(None)
             c_from.avatar = None
 
         c_from.interests = cls.find_tags(data['tag_string'] or '')
@@ -330,6 +402,7 @@ class PostMessage(TagMixin, MessageHandlerBase):
             guid=data['guid'],
             type='public' if public else 'limited'
         )
+        prerender(p.parts)
         db.session.commit()
 
     @classmethod
@@ -377,6 +450,7 @@ class PrivateMessage(SignableMixin, TagMixin, MessageHandlerBase):
         p.thread_modified()
         p.diasp = DiasporaPost(guid=data['guid'], type='private')
         db.session.add(p)
+        prerender(p.parts)
         db.session.commit()
 
     @classmethod
@@ -468,6 +542,7 @@ class SubPost(SignableMixin, TagMixin, MessageHandlerBase):
             type='limited' if u_to else 'public'
         )
         db.session.add(p)
+        prerender(p.parts)
         db.session.commit()
 
         if not(u_to) or (p.parent.author_id == u_to.contact.id):
@@ -510,11 +585,11 @@ class SubPost(SignableMixin, TagMixin, MessageHandlerBase):
         if is_public:
             targets += list(post.author.followers())
         targets = [c for c in targets if not c.user]
-        for target in targets:
-            if is_public:
+        if is_public:
+            for target in targets:
                 cls.send_public(None, target, n=node, fn=_builder)
-            else:
-                cls.send(u_from, target, n=node, fn=_builder)
+        else:
+            cls.send_many(u_from, targets, n=node, fn=_builder)
 
 
 @diaspora_message_handler('/XML/post/message')
@@ -552,6 +627,7 @@ class SubPM(SignableMixin, TagMixin, MessageHandlerBase):
         p.thread_modified()
         p.diasp = DiasporaPost(guid=data['guid'], type='private')
         db.session.add(p)
+        prerender(p.parts)
         db.session.commit()
 
         if not(u_to) or (p.parent.author_id == u_to.contact.id):
@@ -593,8 +669,7 @@ class SubPM(SignableMixin, TagMixin, MessageHandlerBase):
                    if s.contact_id not in already_shared]
         post.share_with(targets)
         targets = [c for c in targets if not c.user]
-        for target in targets:
-            cls.send(u_from, target, n=node, fn=_builder)
+        cls.send_many(u_from, targets, n=node, fn=_builder)
 
 
 @diaspora_message_handler('/XML/post/like')
@@ -629,13 +704,14 @@ class Photo(MessageHandlerBase):
         )
         resp = urlopen(photo_url)
         mime = resp.info().get('Content-Type')
-        parent.add_part(MimePart(
+        part = parent.add_part(MimePart(
             type=resp.info().get('Content-Type'),
             body=resp.read(),
             text_preview='(picture)'
         ), order=0, inline=bool(mime.startswith('image/')))
         parent.thread_modified()
         db.session.add(parent)
+        prerender([part])
         db.session.commit()
 
 
@@ -679,4 +755,41 @@ class Reshare(MessageHandlerBase):
             type='limited' if u_to else 'public'
         )
         db.session.add(post)
+        prerender(post.parts)
         db.session.commit()
+
+
+@command('benchmark_dispatch')
+def benchmark_dispatch(rounds='10000'):
+    """
+    Time choosing the handler for a sample message of each type, against
+    trying every registered XPath in turn.
+    """
+    corpus = [
+        '<XML><post><{0}><guid>1</guid></{0}></post></XML>'.format(tag)
+        for tag in HANDLERS_BY_TAG
+    ] + [
+        # Types distinguished by their content
+        '<XML><post><retraction><post_guid>1</post_guid>'
+        '<type>Person</type></retraction></post></XML>',
+        '<XML><post><participation><guid>1</guid>'
+        '<target_type>Post</target_type></participation></post></XML>',
+    ]
+    corpus = [etree.fromstring(xml) for xml in corpus]
+    assert all(find_handler(doc) for doc in corpus)
+
+    def _scan(doc):
+        for xpath, handler in HANDLERS.items():
+            if doc.xpath(xpath):
+                return handler
+
+    for name, fn in (('dispatch table', find_handler), ('XPath scan', _scan)):
+        start = time()
+        for i in range(int(rounds)):
+            for doc in corpus:
+                fn(doc)
+        elapsed = time() - start
+        count = int(rounds) * len(corpus)
+        print('{0}: {1} messages in {2:.2f}s: {3:.0f} messages/s'.format(
+            name, count, elapsed, count / elapsed if elapsed else 0
+        ))
@@ -0,0 +1,504 @@
+"""
+Delivery of queued outgoing messages to remote servers. Messages are queued
+in the MessageQueue by the request that generates them, and delivered here by
+a separate worker process, so that a slow remote server doesn't hold up the
+local user.
+
+Messages are grouped by server. Each server gets a small pool of persistent
+(keep-alive) connections, and the number of connections open at once is
+bounded both per server and overall.
+"""
+from __future__ import absolute_import, print_function
+
+from base64 import b64encode
+from datetime import datetime, timedelta
+from flask import current_app
+from itertools import count
+from socket import IPPROTO_TCP, TCP_NODELAY
+from sqlalchemy.sql import and_
+from threading import Lock, Semaphore, Thread
+from time import sleep, time
+from traceback import format_exc
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from queue import Empty, Queue
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from httplib import HTTPConnection, HTTPSConnection
+    from Queue import Empty, Queue
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+from pyaspora.database import db
+from pyaspora.diaspora.models import MessageQueue
+from pyaspora.utils.commands import command
+
+DEFAULTS = {
+    'OUTGOING_WORKERS': 8,
+    'OUTGOING_HOST_CONNECTIONS': 2,
+    'OUTGOING_TIMEOUT': 30,
+    'OUTGOING_MAX_ATTEMPTS': 10,
+    'OUTGOING_RETRY_SECONDS': 60,
+    'OUTGOING_MAX_RETRY_SECONDS': 24 * 60 * 60,
+    'OUTGOING_POLL_SECONDS': 5,
+}
+
+
+def _config(name):
+    return current_app.config.get(name, DEFAULTS[name])
+
+
+def retry_delay(attempts):
+    """
+    How long to wait before trying a server again after <attempts>
+    consecutive failures. The delay doubles with each failure.
+    """
+    return timedelta(seconds=min(
+        _config('OUTGOING_RETRY_SECONDS') * 2 ** (attempts - 1),
+        _config('OUTGOING_MAX_RETRY_SECONDS')
+    ))
+
+
+class DeliveryError(Exception):
+    """
+    The remote server did not accept a message.
+    """
+    pass
+
+
+class HostConnectionPool(object):
+    """
+    Persistent HTTP(S) connections to one server, of which at most
+    <max_connections> are in use at once.
+    """
+
+    def __init__(self, scheme, host, max_connections, timeout):
+        self.connection_class = \
+            HTTPSConnection if scheme == 'https' else HTTPConnection
+        self.host = host
+        self.timeout = timeout
+        self.slots = Semaphore(max_connections)
+        self.lock = Lock()
+        self.idle = []
+
+    def _get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connection_class(self.host, timeout=self.timeout), False
+
+    def _release(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    def post(self, path, body):
+        """
+        POST the form-encoded <body> to <path> on the server, raising a
+        DeliveryError if the server does not accept it. Redirects aren't
+        followed, so they count as failures, and the message is kept.
+        """
+        self.slots.acquire()
+        try:
+            conn, reused = self._get()
+            try:
+                resp = self._send(conn, path, body)
+            except Exception:
+                conn.close()
+                if not reused:
+                    raise
+                # The server may have closed an idle connection, so retry
+                # once on a fresh one.
+                conn = self.connection_class(self.host, timeout=self.timeout)
+                try:
+                    resp = self._send(conn, path, body)
+                except Exception:
+                    conn.close()
+                    raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if not 200 <= resp.status < 300:
+                location = resp.getheader('Location')
+                raise DeliveryError('HTTP {0} {1}{2}'.format(
+                    resp.status, resp.reason,
+                    ' to ' + location if location else ''
+                ))
+        finally:
+            self.slots.release()
+
+    def _send(self, conn, path, body):
+        if conn.sock is None:
+            conn.connect()
+            # Headers and body go in separate writes, so don't wait for ACKs
+            conn.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        conn.request('POST', path, body, {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Connection': 'keep-alive',
+        })
+        resp = conn.getresponse()
+        resp.read()  # Must drain the response to re-use the connection
+        return resp
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+def _path(parts):
+    return parts.path + ('?' + parts.query if parts.query else '') or '/'
+
+
+def deliver(messages_by_host, workers, host_connections, timeout):
+    """
+    Deliver messages to several servers concurrently, using up to <workers>
+    threads and <host_connections> connections per server.
+    <messages_by_host> maps a server to a list of (id, url, body) tuples.
+
+    Messages to the same URL are sent in order, and stop at the first
+    failure; after any failure no more messages are sent to that server.
+    Returns a dict mapping message ID to None for success or the error
+    text. Messages that weren't attempted are absent.
+    """
+    pools = {}
+    lanes_by_host = []
+    for host, messages in messages_by_host.items():
+        lanes = {}
+        for message in messages:
+            lanes.setdefault(message[1], []).append(message)
+        lanes_by_host.append([(host, lane) for lane in lanes.values()])
+        parts = urlsplit(messages[0][1])
+        pools[host] = HostConnectionPool(
+            parts.scheme, parts.netloc, host_connections, timeout)
+
+    # Interleave the servers so that the threads spread across them
+    lanes = Queue()
+    for i in count():
+        batch = [h[i] for h in lanes_by_host if i < len(h)]
+        if not batch:
+            break
+        for lane in batch:
+            lanes.put(lane)
+
+    results = {}
+    failed_hosts = set()
+
+    def _worker():
+        while True:
+            try:
+                host, lane = lanes.get_nowait()
+            except Empty:
+                return
+            for message_id, url, body in lane:
+                if host in failed_hosts:
+                    break
+                try:
+                    pools[host].post(_path(urlsplit(url)), body)
+                except Exception:
+                    failed_hosts.add(host)
+                    results[message_id] = format_exc()
+                    break
+                results[message_id] = None
+
+    threads = [
+        Thread(target=_worker)
+        for i in range(min(workers, lanes.qsize()))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for pool in pools.values():
+        pool.close()
+    return results
+
+
+def process_outgoing_queue():
+    """
+    Attempt delivery of all the outgoing messages that are due. A failure
+    puts back delivery of all pending messages for the same server, with an
+    exponentially increasing delay, and a message that fails too many times
+    is set aside as OUTGOING_FAILED. Returns the number of messages
+    delivered.
+    """
+    now = datetime.now()
+    queue_items = db.session.query(MessageQueue).filter(
+        MessageQueue.Queries.outgoing_items_due(
+            now, _config('OUTGOING_MAX_ATTEMPTS'))
+    ).order_by(MessageQueue.created_at, MessageQueue.id).all()
+
+    by_host = {}
+    for qi in queue_items:
+        by_host.setdefault(urlsplit(qi.url).netloc, []).append(qi)
+
+    results = deliver(
+        dict(
+            (host, [(qi.id, qi.url, qi.body) for qi in items])
+            for host, items in by_host.items()
+        ),
+        _config('OUTGOING_WORKERS'),
+        _config('OUTGOING_HOST_CONNECTIONS'),
+        _config('OUTGOING_TIMEOUT')
+    )
+
+    max_attempts = _config('OUTGOING_MAX_ATTEMPTS')
+    delivered = 0
+    for host, items in by_host.items():
+        retry_at = None
+        for qi in items:
+            if results.get(qi.id, True) is None:
+                db.session.delete(qi)
+                delivered += 1
+            elif qi.id in results:
+                qi.attempts += 1
+                qi.error = results[qi.id].encode('utf-8')
+                current_app.logger.warning(
+                    'Delivery to {0} failed (attempt {1})'.
+                    format(host, qi.attempts)
+                )
+                retry_at = max(retry_at or now,
+                               now + retry_delay(qi.attempts))
+                if qi.attempts >= max_attempts:
+                    qi.format = MessageQueue.OUTGOING_FAILED
+        # Everything not delivered waits until the server is retried
+        for qi in items:
+            if results.get(qi.id, True) is not None:
+                qi.next_attempt_at = retry_at
+                db.session.add(qi)
+    db.session.commit()
+    return delivered
+
+
+@command('deliver_outgoing')
+def deliver_outgoing(once=False):
+    """
+    Run the outgoing message worker, which delivers queued messages to remote
+    servers until interrupted (or just once, if an argument is given).
+    """
+    while True:
+        delivered = process_outgoing_queue()
+        if delivered:
+            print('Delivered {0} messages'.format(delivered))
+        if once:
+            return
+        db.session.remove()
+        sleep(_config('OUTGOING_POLL_SECONDS'))
+
+
+def _failed_outgoing():
+    # Messages queued by older versions gave up without changing format
+    db.session.query(MessageQueue). \
+        filter(and_(
+            MessageQueue.format == MessageQueue.OUTGOING,
+            MessageQueue.attempts >= _config('OUTGOING_MAX_ATTEMPTS')
+        )). \
+        update({'format': MessageQueue.OUTGOING_FAILED},
+               synchronize_session=False)
+    return db.session.query(MessageQueue). \
+        filter(MessageQueue.format == MessageQueue.OUTGOING_FAILED)
+
+
+@command('list_failed_outgoing')
+def list_failed_outgoing():
+    """
+    List the outgoing messages that were set aside after failing too many
+    times, with the URL they were for and the last error.
+    """
+    queue_items = _failed_outgoing().order_by(MessageQueue.created_at)
+    for qi in queue_items:
+        error = (qi.error or b'').decode('utf-8').strip().splitlines()
+        print('{0}\t{1}\t{2}\t{3}'.format(
+            qi.id, qi.created_at, qi.url, error[-1] if error else ''))
+    db.session.commit()
+
+
+@command('requeue_failed_outgoing')
+def requeue_failed_outgoing():
+    """
+    Give outgoing messages that were set aside after failing another chance,
+    for example after a server that was down for a long time comes back.
+    """
+    requeued = _failed_outgoing().update({
+        'format': MessageQueue.OUTGOING,
+        'attempts': 0,
+        'next_attempt_at': None,
+    }, synchronize_session=False)
+    db.session.commit()
+    print('Re-queued {0} messages'.format(requeued))
+
+
+@command('purge_failed_outgoing')
+def purge_failed_outgoing():
+    """
+    Delete the outgoing messages that were set aside after failing too many
+    times.
+    """
+    purged = _failed_outgoing().delete(synchronize_session=False)
+    db.session.commit()
+    print('Deleted {0} messages'.format(purged))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakePodHandler(BaseHTTPRequestHandler):
+    """
+    Accepts any POST, as a Diaspora pod's receive endpoints would, and
+    counts it, except that POSTs to paths starting "/moved" are redirected
+    as by a pod that has moved. Also serves the discovery documents
+    (HostMeta, WebFinger, hCard and a photo) for any user at the pod, except
+    those whose names start with "missing", so that importing contacts can
+    be tested.
+    """
+    protocol_version = 'HTTP/1.1'  # For keep-alive
+    disable_nagle_algorithm = True
+    received = count(1)
+    public_key = None
+    delay = 0
+
+    def do_GET(self):
+        sleep(self.delay)
+        parts = urlsplit(self.path)
+        host = self.headers.get('Host')
+        if parts.path == '/.well-known/host-meta':
+            return self._send_document(
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">'
+                '<Link rel="lrdd" type="application/xrd+xml" '
+                'template="http://{0}/webfinger?q={{uri}}"/></XRD>'.
+                format(host),
+                'application/xrd+xml'
+            )
+        if parts.path == '/webfinger':
+            addr = parse_qs(parts.query).get('q', [''])[0]
+            name = addr.split('@')[0].split(':')[-1]
+            if not name or name.startswith('missing'):
+                return self._send_document('', 'text/plain', 404)
+            return self._send_document(
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<XRD xmlns="http://docs.oasis-open.org/ns/xri/xrd-1.0">'
+                '<Subject>{0}</Subject>'
+                '<Link rel="http://microformats.org/profile/hcard" '
+                'type="text/html" href="http://{1}/hcard/{2}"/>'
+                '<Link rel="http://joindiaspora.com/seed_location" '
+                'type="text/html" href="http://{1}/"/>'
+                '<Link rel="http://joindiaspora.com/guid" type="text/html" '
+                'href="{2}-{3}"/>'
+                '<Link rel="diaspora-public-key" type="RSA" href="{4}"/>'
+                '</XRD>'.format(addr, host, name, abs(hash(host)),
+                                self._public_key()),
+                'application/xrd+xml'
+            )
+        if parts.path.startswith('/hcard/'):
+            name = parts.path.split('/')[2]
+            return self._send_document(
+                '<html><body><span class="fn">{0}</span>'
+                '<div id="pod_location">http://{1}/</div>'
+                '<div class="entity_photo">'
+                '<img src="/photo/{0}.png"/></div></body></html>'.
+                format(name, self.headers.get('Host')),
+                'text/html'
+            )
+        if parts.path.startswith('/photo/'):
+            # Smallest valid PNG: one transparent pixel
+            return self._send_document(
+                b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00'
+                b'\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15'
+                b'\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00'
+                b'\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB'
+                b'`\x82',
+                'image/png'
+            )
+        self._send_document('', 'text/plain', 404)
+
+    @classmethod
+    def _public_key(cls):
+        if not cls.public_key:
+            from Crypto.PublicKey import RSA
+            cls.public_key = b64encode(
+                RSA.generate(1024).publickey().exportKey()).decode('ascii')
+        return cls.public_key
+
+    def _send_document(self, body, content_type, status=200):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/moved'):
+            self.send_response(301)
+            self.send_header('Location', 'https://{0}{1}'.format(
+                self.headers.get('Host'), self.path[len('/moved'):]))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+        n = next(self.received)
+        if n % 1000 == 0:
+            print('{0} envelopes received'.format(n))
+
+    def log_message(self, *args):
+        pass
+
+
+@command('fake_pod')
+def fake_pod(port='8001', delay='0'):
+    """
+    Run a local server that accepts deliveries like a remote pod, and serves
+    profiles for its users, for testing and benchmarking delivery and
+    importing contacts without a network. Profile requests take <delay>
+    seconds, to simulate a distant server.
+    """
+    FakePodHandler._public_key()
+    FakePodHandler.delay = float(delay)
+    print('Fake pod listening on http://localhost:{0}/'.format(port))
+    _ThreadingHTTPServer(('', int(port)), FakePodHandler).serve_forever()
+
+
+@command('benchmark_delivery')
+def benchmark_delivery(url='http://localhost:8001/receive/public',
+                       messages='1000', hosts='1'):
+    """
+    Deliver <messages> dummy envelopes to <url> (usually a fake_pod),
+    presented as coming from <hosts> different servers, and report the
+    throughput and how many were not delivered.
+    """
+    body = b'xml=' + b'x' * 4096
+    messages_by_host = {}
+    for i in range(int(messages)):
+        host = 'host{0}'.format(i % int(hosts))
+        messages_by_host.setdefault(host, []).append(
+            (i, '{0}?n={1}'.format(url, i % 10), body)
+        )
+
+    start = time()
+    results = deliver(
+        messages_by_host,
+        _config('OUTGOING_WORKERS'),
+        _config('OUTGOING_HOST_CONNECTIONS'),
+        _config('OUTGOING_TIMEOUT')
+    )
+    elapsed = time() - start
+    sent = len([r for r in results.values() if r is None])
+    print('{0} envelopes in {1:.2f}s: {2:.1f} envelopes/s'.format(
+        sent, elapsed, sent / elapsed if elapsed else 0
+    ))
+    failures = [r for r in results.values() if r is not None]
+    if failures:
+        print('{0} not delivered, the first with: {1}'.format(
+            len(failures), failures[0].strip().splitlines()[-1]))
@@ -0,0 +1,253 @@
+"""
+Background processing of messages received from remote servers. Public
+messages can be processed straight away, but private messages are encrypted
+to the receiving User's key, so can only be processed in the background if
+the node has key escrow enabled (the KEY_ESCROW setting) and the User has
+logged in since. Other Users' messages wait until they load them.
+"""
+from __future__ import absolute_import, print_function
+
+from flask import current_app, request
+from sys import stdin
+from threading import Thread
+from time import sleep, time
+from traceback import format_exc
+try:
+    from queue import Empty, Queue
+except:
+    from Queue import Empty, Queue
+
+from sqlalchemy.sql import and_
+
+from pyaspora.database import db
+from pyaspora.diaspora.models import DiasporaContact, MessageQueue
+from pyaspora.diaspora.protocol import DiasporaMessageParser
+from pyaspora.utils.commands import command
+
+DEFAULTS = {
+    'INCOMING_POLL_SECONDS': 5,
+    'INCOMING_WORKERS': 4,
+    'INCOMING_MAX_ATTEMPTS': 3,
+}
+
+
+def _config(name):
+    return current_app.config.get(name, DEFAULTS[name])
+
+
+def _process_public_item(item_id):
+    """
+    Process one public queue item, returning True if it was processed. An
+    item that fails too many times is set aside as PUBLIC_FAILED.
+    """
+    qi = db.session.query(MessageQueue).get(item_id)
+    try:
+        qi.process_incoming()
+    except Exception:
+        err = format_exc()
+        current_app.logger.error(err)
+        db.session.rollback()
+        qi = db.session.query(MessageQueue).get(item_id)
+        qi.error = err.encode('utf-8')
+        qi.attempts += 1
+        if qi.attempts >= _config('INCOMING_MAX_ATTEMPTS'):
+            qi.format = MessageQueue.PUBLIC_FAILED
+        db.session.add(qi)
+        db.session.commit()
+        return False
+    db.session.delete(qi)
+    db.session.commit()
+    return True
+
+
+def import_public_senders():
+    """
+    Import the senders of queued public messages who aren't known yet, in
+    parallel, and record them against the messages so that the messages can
+    be grouped by sender.
+    """
+    queue_items = db.session.query(MessageQueue).filter(and_(
+        MessageQueue.Queries.pending_public_items(),
+        MessageQueue.remote_id == None
+    ))
+    dmp = DiasporaMessageParser(None)
+    by_sender = {}
+    for qi in queue_items:
+        try:
+            sender = dmp.public_sender(qi.body.decode('ascii'))
+        except Exception:
+            continue  # Will fail properly when processed
+        if sender:
+            by_sender.setdefault(sender, []).append(qi)
+    if not by_sender:
+        return
+
+    contacts = DiasporaContact.import_contacts(by_sender.keys())
+    db.session.flush()
+    for sender, items in by_sender.items():
+        if contacts[sender]:
+            for qi in items:
+                qi.remote_id = contacts[sender].contact_id
+    db.session.commit()
+
+
+def process_public_queue():
+    """
+    Process the public messages that could not be processed on receipt. Only
+    the order of messages from the same sender matters, so each sender's
+    messages are processed in order while different senders are processed in
+    parallel by up to INCOMING_WORKERS threads. A failure holds up later
+    messages from the same sender until the failed message is set aside.
+    Returns the number of messages processed.
+    """
+    import_public_senders()
+    items = db.session.query(MessageQueue.id, MessageQueue.remote_id). \
+        filter(MessageQueue.Queries.pending_public_items()). \
+        order_by(MessageQueue.created_at, MessageQueue.id).all()
+    by_sender = {}
+    for item_id, sender_id in items:
+        by_sender.setdefault(sender_id, []).append(item_id)
+
+    senders = Queue()
+    for item_ids in by_sender.values():
+        senders.put(item_ids)
+
+    app = current_app._get_current_object()
+    base_url = request.url_root if request else None
+    processed = []
+
+    def _worker():
+        with app.test_request_context(base_url=base_url):
+            try:
+                while True:
+                    try:
+                        item_ids = senders.get_nowait()
+                    except Empty:
+                        return
+                    for item_id in item_ids:
+                        if _process_public_item(item_id):
+                            processed.append(item_id)
+                        elif db.session.query(MessageQueue).get(item_id). \
+                                format != MessageQueue.PUBLIC_FAILED:
+                            break  # Retry later, still in order
+            finally:
+                db.session.remove()
+
+    threads = [
+        Thread(target=_worker)
+        for i in range(min(_config('INCOMING_WORKERS'), senders.qsize()))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(processed)
+
+
+def process_incoming_queues():
+    """
+    Process the incoming messages for every User whose key is held in
+    escrow, and the public queue. Returns the number of messages processed.
+    """
+    processed = 0
+    for user in MessageQueue.users_with_pending_items().all():
+        key = user.unlock_escrowed_key()
+        if not key:
+            continue
+        user._unlocked_key = key
+        processed += MessageQueue.process_incoming_queue(user)
+    processed += process_public_queue()
+    return processed
+
+
+@command('process_incoming')
+def process_incoming(once=False):
+    """
+    Run the incoming message worker, which processes messages received from
+    remote servers, and downloads remote contacts' pictures, until
+    interrupted (or just once, if an argument is given).
+    """
+    if not current_app.config.get('KEY_ESCROW', False):
+        print('KEY_ESCROW is not enabled; only public messages will be '
+              'processed')
+    while True:
+        start = time()
+        processed = process_incoming_queues()
+        if processed:
+            elapsed = time() - start
+            print('Processed {0} messages in {1:.2f}s: {2:.1f} messages/s'.
+                  format(processed, elapsed,
+                         processed / elapsed if elapsed else 0))
+        fetched = DiasporaContact.fetch_avatars()
+        db.session.commit()
+        if fetched:
+            print('Fetched {0} pictures'.format(fetched))
+        if once:
+            return
+        db.session.remove()
+        sleep(_config('INCOMING_POLL_SECONDS'))
+
+
+@command('import_contacts')
+def import_contacts(*addrs):
+    """
+    Import the Diaspora users named on the command line (or one per line on
+    standard input, if none are named) as contacts, fetching their details
+    in parallel. Useful for filling in the contacts of a migrated account.
+    """
+    if not addrs:
+        addrs = [line.strip() for line in stdin if line.strip()]
+    start = time()
+    contacts = DiasporaContact.import_contacts(addrs)
+    db.session.commit()
+    elapsed = time() - start
+    failed = sorted(a for a, c in contacts.items() if not c)
+    for addr in failed:
+        print('Could not import {0}'.format(addr))
+    print('{0} contacts available, {1} failed, in {2:.2f}s'.format(
+        len(contacts) - len(failed), len(failed), elapsed))
+
+
+@command('fetch_avatars')
+def fetch_avatars():
+    """
+    Download the pictures of remote contacts that are waiting for one, as
+    the incoming message worker would.
+    """
+    total = 0
+    while True:
+        fetched = DiasporaContact.fetch_avatars()
+        db.session.commit()
+        if not fetched:
+            break
+        total += fetched
+    print('Fetched {0} pictures'.format(total))
+
+
+@command('forget_escrowed_keys')
+def forget_escrowed_keys():
+    """
+    Delete every escrowed private key, for example after disabling escrow.
+    """
+    from pyaspora.user.models import User
+    count = db.session.query(User). \
+        filter(User.escrowed_key != None). \
+        update({'escrowed_key': None}, synchronize_session=False)
+    db.session.commit()
+    print('Forgot {0} escrowed keys'.format(count))
+
+
+@command('requeue_failed_public')
+def requeue_failed_public():
+    """
+    Give public messages that were set aside after failing another chance,
+    for example after fixing the bug that made them fail.
+    """
+    count = db.session.query(MessageQueue). \
+        filter(MessageQueue.format == MessageQueue.PUBLIC_FAILED). \
+        update({
+            'format': MessageQueue.PUBLIC_INCOMING,
+            'attempts': 0,
+        }, synchronize_session=False)
+    db.session.commit()
+    print('Re-queued {0} messages'.format(count))
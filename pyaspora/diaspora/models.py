@@ -1,14 +1,18 @@
 from __future__ import absolute_import
 
 from base64 import b64decode
+from datetime import datetime, timedelta
+from dateutil.tz import tzutc
 from flask import current_app, request, url_for
 from lxml import html
 from sqlalchemy import Column, DateTime, ForeignKey, Integer, LargeBinary, \
     String
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import backref, relationship
-from sqlalchemy.sql import and_
+from sqlalchemy.sql import and_, or_
 from sqlalchemy.sql.expression import func
-from traceback import format_exc
+from threading import Lock, Thread
+from traceback import format_exc, format_exception_only
 from uuid import uuid4
 try:
     from urllib.error import URLError
@@ -21,9 +25,13 @@ except:
 
 from pyaspora import db
 from pyaspora.contact.models import Contact
-from pyaspora.diaspora import import_url_as_mimepart
-from pyaspora.diaspora.protocol import DiasporaMessageParser, WebfingerRequest
+from pyaspora.content.images import make_variants
+from pyaspora.content.models import MimePart
+from pyaspora.diaspora import fetch_url
+from pyaspora.diaspora.protocol import DiasporaMessageParser, HostMeta, \
+    parse_xml, WebfingerRequest
 from pyaspora.post.views import json_post
+from pyaspora.utils.threads import map_in_threads
 
 
 class DiasporaContact(db.Model):
@@ -32,6 +40,8 @@ class DiasporaContact(db.Model):
     guid = Column(String, nullable=False, unique=True)
     username = Column(String, nullable=False, unique=True)
     server = Column(String, nullable=False)
+    avatar_url = Column(String, nullable=True)
+    avatar_attempts = Column(Integer, nullable=False, default=0)
 
     contact = relationship('Contact', single_parent=True,
                            backref=backref('diasp', uselist=False))
@@ -65,6 +75,7 @@ class DiasporaContact(db.Model):
         if dcontact:
             return dcontact
 
+        contact = None
         if import_contact:
             contact = cls.import_contact(addr)
             if commit:
@@ -78,69 +89,214 @@ class DiasporaContact(db.Model):
         provided.
         """
         try:
-            wf = WebfingerRequest(addr).fetch()
+            wf = DiscoveryCache.webfinger(addr)
         except URLError:
             return None
         if not wf:
             return None
 
-        NS = {'XRD': 'http://docs.oasis-open.org/ns/xri/xrd-1.0'}
+        return cls._create(cls._fetch_profile(wf))
 
-        c = Contact()
+    @classmethod
+    def import_contacts(cls, addrs, workers=None):
+        """
+        Import the Diaspora users with usernames <addrs> (of form
+        "user@host"), fetching their details in parallel using up to
+        <workers> threads (the IMPORT_WORKERS setting by default). Each
+        server's HostMeta is only fetched once. Returns a dict mapping each
+        username to its DiasporaContact, or None if it can't be imported.
+        Users already known are not fetched again. The caller must commit
+        the session.
+        """
+        if workers is None:
+            workers = current_app.config.get('IMPORT_WORKERS', 8)
+        addrs = set(addrs)
+        results = dict((a, None) for a in addrs)
+        if not addrs:
+            return results
+
+        for d in db.session.query(cls).filter(cls.username.in_(addrs)):
+            results[d.username] = d
+        requests = {}
+        for addr in addrs:
+            if results[addr]:
+                continue
+            try:
+                requests[addr] = WebfingerRequest(addr)
+            except (TypeError, AttributeError):
+                pass  # Not a valid username
+
+        templates = DiscoveryCache.lookup_many(
+            DiscoveryCache.HOST_META,
+            set(r.hostmeta.request_host for r in requests.values()),
+            lambda host: HostMeta(host).fetch_template().encode('utf-8'),
+            workers
+        )
+        by_account = {}
+        for addr, req in requests.items():
+            template = templates[req.hostmeta.request_host]
+            if template.document is not None:
+                by_account[req.account()] = \
+                    (addr, req, template.document.decode('utf-8'))
+
+        def _webfinger(account):
+            addr, req, template = by_account[account]
+            return req.fetch_document(template)
+
+        webfingers = DiscoveryCache.lookup_many(
+            DiscoveryCache.WEBFINGER, by_account.keys(), _webfinger, workers)
+
+        def _profile(account):
+            return cls._fetch_profile(parse_xml(webfingers[account].result()))
+
+        profiles = map_in_threads(
+            _profile,
+            [a for a, e in webfingers.items() if e.document is not None],
+            workers
+        )
+        for account, (profile, e) in profiles.items():
+            addr = by_account[account][0]
+            if e:
+                current_app.logger.warning(
+                    'Could not import {0}: {1}'.format(addr, e))
+                continue
+            existing = cls.get_by_username(
+                profile['username'], import_contact=False)
+            results[addr] = existing or cls._create(profile)
+        return results
+
+    @classmethod
+    def _fetch_profile(cls, wf):
+        """
+        Fetch the remaining information about a Diaspora user, given their
+        WebFinger profile <wf>, and return it as a dict. This doesn't use the
+        database, so can be done in parallel.
+        """
+        NS = {'XRD': 'http://docs.oasis-open.org/ns/xri/xrd-1.0'}
+        profile = {}
 
         pk = wf.xpath('//XRD:Link[@rel="diaspora-public-key"]/@href',
                       namespaces=NS)[0]
-        c.public_key = b64decode(pk).decode("ascii")
+        profile['public_key'] = b64decode(pk).decode("ascii")
 
         hcard_url = wf.xpath(
             '//XRD:Link[@rel="http://microformats.org/profile/hcard"]/@href',
             namespaces=NS
         )[0]
-        hcard = html.parse(urlopen(hcard_url))
-        c.realname = hcard.xpath('//*[@class="fn"]')[0].text
+        hcard = html.parse(urlopen(hcard_url, timeout=5))
+        profile['realname'] = hcard.xpath('//*[@class="fn"]')[0].text
 
         pod_loc = hcard.xpath('//*[@id="pod_location"]')[0].text
         photo_url = hcard.xpath('//*[@class="entity_photo"]//img/@src')[0]
-        if photo_url:
-            mp = import_url_as_mimepart(urljoin(pod_loc, photo_url))
-            mp.text_preview = '(picture for {0})'.format(
-                c.realname or '(anonymous)'
-            )
-            c.avatar = mp
+        profile['avatar_url'] = \
+            urljoin(pod_loc, photo_url) if photo_url else None
 
-        username = wf.xpath(
+        profile['username'] = wf.xpath(
             '//XRD:Subject/text()',
             namespaces=NS
-        )[0].split(':')[1]
-        guid = wf.xpath(
+        )[0].split(':', 1)[1]
+        profile['guid'] = wf.xpath(
             ".//XRD:Link[@rel='http://joindiaspora.com/guid']",
             namespaces=NS
         )[0].get("href")
-        server = wf.xpath(
+        profile['server'] = wf.xpath(
             ".//XRD:Link[@rel='http://joindiaspora.com/seed_location']",
             namespaces=NS
         )[0].get("href")
+        return profile
+
+    @classmethod
+    def _create(cls, profile):
+        """
+        Create a Contact for a Diaspora user from the dict <profile> returned
+        by _fetch_profile().
+        """
+        c = Contact()
+        c.public_key = profile['public_key']
+        c.realname = profile['realname']
+
         d = cls(
             contact=c,
-            guid=guid,
-            username=username,
-            server=server
+            guid=profile['guid'],
+            username=profile['username'],
+            server=profile['server']
         )
+        d.set_avatar_url(profile['avatar_url'])
         db.session.add(d)
         db.session.add(c)
 
         return d
 
-    def photo_url(self):
+    def set_avatar_url(self, url):
+        """
+        Note that the contact's picture is at <url>, for fetch_avatars() to
+        download later. Until then the existing picture (or a placeholder)
+        is shown.
+        """
+        self.avatar_url = url
+        self.avatar_attempts = 0
+
+    @classmethod
+    def fetch_avatars(cls, workers=None, limit=100):
+        """
+        Download up to <limit> pictures noted by set_avatar_url(), in
+        parallel. Pictures larger than the AVATAR_MAX_BYTES setting or that
+        aren't images are refused, and a picture is given up on after
+        AVATAR_MAX_ATTEMPTS failures. Returns the number downloaded. The
+        caller must commit the session.
+        """
+        if workers is None:
+            workers = current_app.config.get('IMPORT_WORKERS', 8)
+        max_bytes = current_app.config.get('AVATAR_MAX_BYTES', 256 * 1024)
+        pending = db.session.query(cls).filter(and_(
+            cls.avatar_url != None,
+            cls.avatar_attempts < current_app.config.get(
+                'AVATAR_MAX_ATTEMPTS', 3)
+        )).limit(limit).all()
+
+        def _fetch(url):
+            mime_type, body = fetch_url(url, max_bytes, timeout=10)
+            if not (mime_type or '').startswith('image/'):
+                raise ValueError(
+                    '{0} is not an image ({1})'.format(url, mime_type))
+            return mime_type, body
+
+        results = map_in_threads(
+            _fetch, set(d.avatar_url for d in pending), workers)
+        fetched = 0
+        for d in pending:
+            image, e = results[d.avatar_url]
+            if e:
+                current_app.logger.warning('Could not fetch {0}: {1}'.format(
+                    d.avatar_url, e))
+                d.avatar_attempts += 1
+                continue
+            d.contact.avatar = MimePart(
+                type=image[0],
+                body=image[1],
+                text_preview='(picture for {0})'.format(
+                    d.contact.realname or '(anonymous)')
+            )
+            d.avatar_url = None
+            db.session.add(d.contact)
+            db.session.flush()
+            make_variants(d.contact.avatar)
+            fetched += 1
+        return fetched
+
+    def photo_url(self, size=None):
         """
         Diaspora requires all contacts have pictures, even if they haven't
         chosen one. This call returns a default if a picture hasn't been
-        uploaded.
+        uploaded. If <size> is given the picture is scaled to fit that many
+        pixels.
         """
         if self.contact.avatar:
             return url_for(
                 'contacts.avatar',
                 contact_id=self.contact_id,
+                v=self.contact.avatar_id,
+                size=size,
                 _external=True
             )
         else:
@@ -151,10 +307,256 @@ class DiasporaContact(db.Model):
             )
 
 
+class DiscoveryError(URLError):
+    """
+    Information about a remote user or server could not be fetched (now or
+    recently).
+    """
+    pass
+
+
+class DiscoveryCache(db.Model):
+    """
+    Documents fetched from remote servers to discover Diaspora users: the
+    WebFinger URL template from each server's HostMeta, and each account's
+    WebFinger profile. Failures are cached too, for a shorter time, so that
+    an unreachable server isn't contacted on every lookup. An expired
+    document is still used for a while, whilst it is re-fetched in the
+    background.
+
+    Fields:
+        kind - HOST_META or WEBFINGER
+        key - the host name or account URL that the document is for
+        document - the document, or None if it could not be fetched
+        error - why the document could not be fetched
+        fetched_at - when the document was last fetched successfully
+        expires_at - when the entry should next be re-fetched
+    """
+    HOST_META = 'host-meta'
+    WEBFINGER = 'webfinger'
+
+    DEFAULTS = {
+        'DISCOVERY_TTL': 24 * 60 * 60,
+        'DISCOVERY_FAILURE_TTL': 10 * 60,
+        'DISCOVERY_STALE_TTL': 7 * 24 * 60 * 60,
+    }
+
+    __tablename__ = 'diaspora_discovery_cache'
+    kind = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    document = Column(LargeBinary, nullable=True)
+    error = Column(String, nullable=True)
+    fetched_at = Column(DateTime(timezone=True), nullable=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    # Entries being re-fetched in the background, by this process
+    _refreshing = set()
+    _refreshing_lock = Lock()
+
+    @classmethod
+    def _ttl(cls, name):
+        return timedelta(
+            seconds=current_app.config.get(name, cls.DEFAULTS[name]))
+
+    @classmethod
+    def webfinger(cls, addr):
+        """
+        Return the WebFinger profile of the Diaspora user <addr> (of form
+        "user@host"), as an XML document. Raises DiscoveryError if it can't
+        be fetched. The caller must commit the session.
+        """
+        req = WebfingerRequest(addr)
+        host = req.hostmeta.request_host
+
+        def _template():
+            return HostMeta(host).fetch_template().encode('utf-8')
+
+        def _profile():
+            template = cls.lookup(cls.HOST_META, host, _template)
+            return req.fetch_document(template.decode('utf-8'))
+
+        return parse_xml(cls.lookup(cls.WEBFINGER, req.account(), _profile))
+
+    @classmethod
+    def lookup(cls, kind, key, fetch):
+        """
+        Return the document of type <kind> for <key>, calling <fetch> to
+        fetch it if there is no usable entry. Raises DiscoveryError if it
+        can't be fetched. The caller must commit the session.
+        """
+        now = datetime.now(tzutc())
+        entry = db.session.query(cls).get((kind, key))
+        if entry and entry.is_fresh(now):
+            return entry.result()
+        if entry and entry.usable_when_stale(now):
+            cls._refresh_in_background(kind, key, fetch)
+            return entry.document
+        return cls._fetch(kind, key, fetch, entry).result()
+
+    @classmethod
+    def lookup_many(cls, kind, keys, fetch, workers):
+        """
+        Look up the documents of type <kind> for each of <keys>, as lookup()
+        does, and return a dict mapping each key to its DiscoveryCache entry.
+        Missing documents are fetched in parallel by up to <workers> threads
+        calling <fetch> with the key, which must not use the database. The
+        caller must commit the session.
+        """
+        now = datetime.now(tzutc())
+        keys = set(keys)
+        entries = dict(
+            (e.key, e) for e in db.session.query(cls).filter(and_(
+                cls.kind == kind,
+                cls.key.in_(keys)
+            ))
+        ) if keys else {}
+
+        results = {}
+        missing = []
+        for key in keys:
+            entry = entries.get(key, None)
+            if entry and entry.is_fresh(now):
+                results[key] = entry
+            elif entry and entry.usable_when_stale(now):
+                cls._refresh_in_background(
+                    kind, key, lambda key=key: fetch(key))
+                results[key] = entry
+            else:
+                missing.append(key)
+
+        fetched = map_in_threads(fetch, missing, workers)
+        for key, (document, e) in fetched.items():
+            error = None
+            if e:
+                current_app.logger.warning(
+                    'Could not fetch {0} for {1}: {2}'.format(kind, key, e))
+                error = ''.join(format_exception_only(type(e), e))
+            results[key] = cls._record(
+                kind, key, entries.get(key, None), document, error)
+        return results
+
+    @staticmethod
+    def _utc(value):
+        # Some databases (eg. SQLite) give back times without a timezone;
+        # they are stored in UTC
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=tzutc())
+        return value
+
+    def is_fresh(self, now):
+        """
+        Whether the entry can be used without re-fetching it.
+        """
+        return self._utc(self.expires_at) > now
+
+    def usable_when_stale(self, now):
+        """
+        Whether an expired document can still be used until it's re-fetched.
+        """
+        return self.document is not None and self.fetched_at and \
+            self._utc(self.fetched_at) + self._ttl('DISCOVERY_TTL') + \
+            self._ttl('DISCOVERY_STALE_TTL') > now
+
+    def result(self):
+        """
+        The document, or raise DiscoveryError if it could not be fetched.
+        """
+        if self.document is None:
+            raise DiscoveryError(self.error)
+        return self.document
+
+    @classmethod
+    def _fetch(cls, kind, key, fetch, entry=None):
+        """
+        Call <fetch> to fetch a document and record the outcome in <entry>
+        (created if None), which is returned.
+        """
+        try:
+            document = fetch()
+        except Exception as e:
+            current_app.logger.warning(
+                'Could not fetch {0} for {1}: {2}'.format(kind, key, e))
+            return cls._record(kind, key, entry, error=format_exc())
+        return cls._record(kind, key, entry, document=document)
+
+    @classmethod
+    def _record(cls, kind, key, entry, document=None, error=None):
+        """
+        Record in <entry> (created if None) that a document was fetched, or
+        that fetching it failed with <error>, and return the entry. If
+        fetching failed, a document that is still usable when stale is kept.
+        """
+        if entry is not None:
+            entry._update(document, error)
+            return entry
+
+        # Another request may be storing the same entry, so the new row is
+        # written in a savepoint, and updated instead if it loses the race
+        entry = cls(kind=kind, key=key)
+        entry._update(document, error)
+        try:
+            with db.session.begin_nested():
+                db.session.add(entry)
+        except IntegrityError:
+            entry = db.session.query(cls).get((kind, key))
+            entry._update(document, error)
+        return entry
+
+    def _update(self, document, error):
+        """
+        Record the outcome of a fetch, as _record() describes.
+        """
+        now = datetime.now(tzutc())
+        if error:
+            if not self.usable_when_stale(now):
+                self.document = None
+            self.error = error
+            self.expires_at = now + self._ttl('DISCOVERY_FAILURE_TTL')
+        else:
+            self.document = document
+            self.error = None
+            self.fetched_at = now
+            self.expires_at = now + self._ttl('DISCOVERY_TTL')
+
+    @classmethod
+    def _refresh_in_background(cls, kind, key, fetch):
+        """
+        Re-fetch a document in another thread, unless that's already
+        happening.
+        """
+        with cls._refreshing_lock:
+            if (kind, key) in cls._refreshing:
+                return
+            cls._refreshing.add((kind, key))
+
+        app = current_app._get_current_object()
+
+        def _refresh():
+            try:
+                with app.app_context():
+                    try:
+                        cls._fetch(
+                            kind, key, fetch,
+                            db.session.query(cls).get((kind, key))
+                        )
+                        db.session.commit()
+                    finally:
+                        db.session.remove()
+            finally:
+                with cls._refreshing_lock:
+                    cls._refreshing.discard((kind, key))
+
+        Thread(target=_refresh).start()
+
+
 class MessageQueue(db.Model):
     """
     Messages that have been received but that cannot be actioned until the
-    User's public key has been unlocked (at which point they will be deleted).
+    User's public key has been unlocked (at which point they will be deleted),
+    public messages that could not be processed on receipt (which are retried
+    a few times and then set aside as PUBLIC_FAILED), and messages waiting to
+    be delivered to remote servers (set aside as OUTGOING_FAILED once they
+    have failed too many times).
 
     Fields:
         id - an integer identifier uniquely identifying the message in the
@@ -163,9 +565,17 @@ class MessageQueue(db.Model):
         remote_id - the Contact the message is to/from
         format - the protocol format of the payload
         body - the message payload, in a protocol-specific format
+        url - for outgoing messages, the URL to deliver the message to
+        attempts - the number of failed attempts to deliver or process the
+                   message
+        next_attempt_at - for outgoing messages, when delivery should next be
+                          attempted (None for as soon as possible)
     """
     INCOMING = 'application/x-diaspora-slap'
     PUBLIC_INCOMING = 'application/x-diaspora-public-slap'
+    PUBLIC_FAILED = 'application/x-diaspora-failed-public-slap'
+    OUTGOING = 'application/x-diaspora-outgoing-slap'
+    OUTGOING_FAILED = 'application/x-diaspora-failed-outgoing-slap'
 
     __tablename__ = 'message_queue'
     id = Column(Integer, primary_key=True)
@@ -176,6 +586,10 @@ class MessageQueue(db.Model):
     created_at = Column(DateTime(timezone=True),
                         nullable=False, default=func.now())
     error = Column(LargeBinary, nullable=True)
+    url = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=True,
+                             default=None)
 
     local_user = relationship('User', backref='message_queue')
 
@@ -191,6 +605,34 @@ class MessageQueue(db.Model):
         def pending_public_items(cls):
             return MessageQueue.format == MessageQueue.PUBLIC_INCOMING
 
+        @classmethod
+        def outgoing_items_due(cls, now, max_attempts):
+            return and_(
+                MessageQueue.format == MessageQueue.OUTGOING,
+                MessageQueue.attempts < max_attempts,
+                or_(
+                    MessageQueue.next_attempt_at == None,
+                    MessageQueue.next_attempt_at <= now
+                )
+            )
+
+    @classmethod
+    def queue_outgoing(cls, u_from, c_to, url, body):
+        """
+        Queue the encoded message <body> from User <u_from> (which may be None
+        for relayed public messages) for delivery to <url> on the server of
+        Contact <c_to>. The caller must commit the session.
+        """
+        queue_item = cls(
+            local_user=u_from,
+            remote_id=c_to.id,
+            format=cls.OUTGOING,
+            url=url,
+            body=body
+        )
+        db.session.add(queue_item)
+        return queue_item
+
     @classmethod
     def has_pending_items(cls, user):
         first = db.session.query(cls).filter(
@@ -198,6 +640,21 @@ class MessageQueue(db.Model):
         ).order_by(cls.created_at).first()
         return bool(first and not first.error)
 
+    @classmethod
+    def users_with_pending_items(cls):
+        """
+        The Users who have incoming items waiting and whose keys are held in
+        escrow, so that the items can be processed without them.
+        """
+        from pyaspora.user.models import User
+        return db.session.query(User). \
+            join(cls, cls.local_id == User.id). \
+            filter(and_(
+                cls.format == cls.INCOMING,
+                User.escrowed_key != None
+            )). \
+            group_by(User.id)
+
     @classmethod
     def process_incoming_queue(cls, user, max_items=None):
         queue_items = db.session.query(MessageQueue).filter(
@@ -222,6 +679,7 @@ class MessageQueue(db.Model):
             else:
                 db.session.delete(qi)
         db.session.commit()
+        return processed
 
     def process_incoming(self, user=None):
         from pyaspora.diaspora.actions import process_incoming_message
@@ -330,8 +788,7 @@ class DiasporaPost(db.Model):
             # Can only send to followers
             followers = set([c.id for c in post.author.followers()])
             targets = [t for t in targets if t.id in followers]
-            for target in targets:
-                sender.send(post.author.user, target, post=post, text=text)
+            sender.send_many(post.author.user, targets, post=post, text=text)
 
     def can_change_privacy(self):
         return False  # Generally, no
@@ -3,7 +3,6 @@ from __future__ import absolute_import
 from base64 import b64decode, b64encode, urlsafe_b64decode, urlsafe_b64encode
 from Crypto.Cipher import AES, PKCS1_v1_5
 from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
 from Crypto.Signature import PKCS1_v1_5 as PKCSSign
 from flask import current_app
@@ -11,21 +10,120 @@ from json import dumps, loads
 from lxml import etree
 from re import match as re_match, sub as re_sub
 from sys import version as python_version
+from threading import local
 try:
-    from urllib.parse import quote as url_quote, quote_plus, unquote_plus, \
-        urlencode, urlparse
+    from urllib.parse import quote as url_quote, quote_plus, \
+        unquote_to_bytes, urlencode, urlparse
     from urllib.request import build_opener, HTTPRedirectHandler, Request, \
         urlopen
 except:
-    from urllib import quote as url_quote, quote_plus, unquote_plus, \
-        urlencode, urlopen
+    from urllib import quote as url_quote, quote_plus, \
+        unquote as unquote_to_bytes, urlencode, urlopen
     from urllib2 import build_opener, HTTPRedirectHandler, Request
     from urlparse import urlparse
 
+from pyaspora.utils.keys import public_key_for
+
 
 # The namespace for the Diaspora envelope
 PROTOCOL_NS = "https://joindiaspora.com/protocol"
 
+# The largest incoming message accepted, unless overridden by the
+# INCOMING_MAX_BYTES setting
+DEFAULT_MAX_MESSAGE_BYTES = 1024 * 1024
+
+# How much URL-encoded XML to decode at once when parsing incrementally
+PARSE_CHUNK_SIZE = 64 * 1024
+
+_parsers = local()
+
+
+class MessageTooLarge(ValueError):
+    """
+    An incoming message is larger than this node accepts.
+    """
+    pass
+
+
+def max_message_bytes():
+    """
+    The size in bytes of the largest incoming message (as posted, so still
+    URL-encoded) that will be accepted.
+    """
+    return current_app.config.get(
+        'INCOMING_MAX_BYTES', DEFAULT_MAX_MESSAGE_BYTES)
+
+
+def check_message_size(size):
+    """
+    Raise MessageTooLarge if a message of <size> bytes is too large.
+    """
+    if size > max_message_bytes():
+        raise MessageTooLarge(
+            'Message of {0} bytes is too large'.format(size))
+
+
+def xml_parser():
+    """
+    An XMLParser for XML received from other nodes, which does not resolve
+    entities, load DTDs or access the network, and keeps libxml2's limits on
+    very large or deep documents. Parsers can be reused but not shared
+    between threads, so each thread has its own.
+    """
+    parser = getattr(_parsers, 'parser', None)
+    if parser is None:
+        parser = _parsers.parser = etree.XMLParser(
+            resolve_entities=False,
+            load_dtd=False,
+            no_network=True,
+            huge_tree=False
+        )
+    return parser
+
+
+def parse_xml(xml):
+    """
+    Parse the XML document <xml> (bytes) received from another node, after
+    checking its size.
+    """
+    check_message_size(len(xml))
+    return etree.fromstring(xml, xml_parser())
+
+
+def parse_quoted_xml(quoted):
+    """
+    Parse the URL-encoded XML document <quoted> received from another node,
+    after checking its size. It is decoded and fed to the parser a piece at a
+    time, so that a decoded copy of the whole document is never held.
+    """
+    check_message_size(len(quoted))
+    parser = xml_parser()
+    start = 0
+    leading = True
+    try:
+        while start < len(quoted):
+            end = start + PARSE_CHUNK_SIZE
+            if end < len(quoted):
+                # Don't split a %XX escape between chunks
+                escape = quoted.find('%', end - 2, end)
+                if escape != -1:
+                    end = escape
+            chunk = unquote_to_bytes(quoted[start:end].replace('+', ' '))
+            if leading:
+                chunk = chunk.lstrip()
+                leading = not chunk
+            if chunk:
+                parser.feed(chunk)
+            start = end
+        return parser.close()
+    except Exception:
+        # Leave the parser ready for the next document
+        try:
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        raise
+
 
 class DiasporaMessageBuilder:
     """
@@ -42,7 +140,8 @@ class DiasporaMessageBuilder:
         Build a Diaspora message and prepare to send the payload <message>,
         authored by Contact <author>. The receipient is specified later, so
         that the same message can be sent to several people without needing to
-        keep re-encrypting the inner.
+        keep re-encrypting the inner: the payload is encrypted and signed once,
+        and only the outer AES key bundle is encrypted for each recipient.
         """
 
         # We need an AES key for the envelope
@@ -60,6 +159,11 @@ class DiasporaMessageBuilder:
         self.author_username = author_username
         self.private_key = private_key
 
+        # The parts that are the same for every recipient, once generated
+        self.ciphertext = None
+        self.encrypted_payload = None
+        self.signed_data = {}
+
     def xml_to_string(self, doc, xml_declaration=False):
         """
         Utility function to turn an XML document to a string. This is
@@ -95,14 +199,16 @@ class DiasporaMessageBuilder:
 
     def create_ciphertext(self):
         """
-        Encrypt the header.
+        Encrypt the header. This is only done once, as the encrypter carries
+        on from where it left off.
         """
-        to_encrypt = self.pkcs7_pad(
-            self.create_decrypted_header(),
-            AES.block_size
-        )
-        out = self.outer_encrypter.encrypt(to_encrypt)
-        return out
+        if self.ciphertext is None:
+            to_encrypt = self.pkcs7_pad(
+                self.create_decrypted_header(),
+                AES.block_size
+            )
+            self.ciphertext = self.outer_encrypter.encrypt(to_encrypt)
+        return self.ciphertext
 
     def create_outer_aes_key_bundle(self):
         """
@@ -162,10 +268,41 @@ class DiasporaMessageBuilder:
 
     def create_encrypted_payload(self):
         """
-        Encrypt the payload XML with the inner (body) key.
+        Encrypt the payload XML with the inner (body) key. This is only done
+        once, as the encrypter carries on from where it left off.
+        """
+        if self.encrypted_payload is None:
+            to_encrypt = self.pkcs7_pad(self.create_payload(), AES.block_size)
+            self.encrypted_payload = self.inner_encrypter.encrypt(to_encrypt)
+        return self.encrypted_payload
+
+    def create_signed_data(self, encrypted):
+        """
+        Encode the payload (encrypted with the inner key if <encrypted>) and
+        sign it with the author's key. The result is the same for every
+        recipient, so is only generated once.
         """
-        to_encrypt = self.pkcs7_pad(self.create_payload(), AES.block_size)
-        return self.inner_encrypter.encrypt(to_encrypt)
+        if encrypted in self.signed_data:
+            return self.signed_data[encrypted]
+
+        if encrypted:
+            payload = urlsafe_b64encode(b64encode(
+                self.create_encrypted_payload())).decode("ascii")
+        else:
+            payload = urlsafe_b64encode(self.create_payload()).decode("ascii")
+        # Split every 60 chars
+        payload = '\n'.join([payload[start:start+60]
+                             for start in range(0, len(payload), 60)])
+        payload = payload + "\n"
+        sig_contents = payload + "." + \
+            b64encode(b"application/xml").decode("ascii") + "." + \
+            b64encode(b"base64url").decode("ascii") + "." + \
+            b64encode(b"RSA-SHA256").decode("ascii")
+        sig_hash = SHA256.new(sig_contents.encode("ascii"))
+        cipher = PKCSSign.new(self.private_key)
+        sig = urlsafe_b64encode(cipher.sign(sig_hash))
+        self.signed_data[encrypted] = (payload, sig)
+        return payload, sig
 
     def create_salmon_envelope(self, recipient_public_key):
         """
@@ -185,24 +322,9 @@ class DiasporaMessageBuilder:
         env = etree.SubElement(doc, "{%s}env" % nsmap["me"])
         etree.SubElement(env, "{%s}encoding" % nsmap["me"]).text = 'base64url'
         etree.SubElement(env, "{%s}alg" % nsmap["me"]).text = 'RSA-SHA256'
-        if recipient_public_key:
-            payload = urlsafe_b64encode(b64encode(
-                self.create_encrypted_payload())).decode("ascii")
-        else:
-            payload = urlsafe_b64encode(self.create_payload()).decode("ascii")
-        # Split every 60 chars
-        payload = '\n'.join([payload[start:start+60]
-                             for start in range(0, len(payload), 60)])
-        payload = payload + "\n"
+        payload, sig = self.create_signed_data(bool(recipient_public_key))
         etree.SubElement(env, "{%s}data" % nsmap["me"],
                          {"type": "application/xml"}).text = payload
-        sig_contents = payload + "." + \
-            b64encode(b"application/xml").decode("ascii") + "." + \
-            b64encode(b"base64url").decode("ascii") + "." + \
-            b64encode(b"RSA-SHA256").decode("ascii")
-        sig_hash = SHA256.new(sig_contents.encode("ascii"))
-        cipher = PKCSSign.new(self.private_key)
-        sig = urlsafe_b64encode(cipher.sign(sig_hash))
         etree.SubElement(env, "{%s}sig" % nsmap["me"]).text = sig
         return self.xml_to_string(doc)
 
@@ -224,16 +346,31 @@ class DiasporaMessageBuilder:
         else:
             return bytes(vals)
 
-    def post(self, url, recipient_public_key):
+    def post_body(self, recipient_public_key):
         """
-        Actually send the message to an HTTP/HTTPs endpoint.
+        Build the form-encoded request body that carries the message to an
+        HTTP/HTTPS endpoint.
         """
         xml = url_quote(
             self.create_salmon_envelope(recipient_public_key))
         data = urlencode({
             'xml': xml
         })
-        return urlopen(url, data.encode("ascii"))
+        return data.encode("ascii")
+
+    def post_bodies(self, recipient_public_keys):
+        """
+        Build the request bodies for sending the message to each of the
+        recipients with public keys <recipient_public_keys>. The payload is
+        encrypted and signed once; only the key bundle differs.
+        """
+        return [self.post_body(key) for key in recipient_public_keys]
+
+    def post(self, url, recipient_public_key):
+        """
+        Actually send the message to an HTTP/HTTPs endpoint.
+        """
+        return urlopen(url, self.post_body(recipient_public_key))
 
 
 class DiasporaMessageParser:
@@ -245,20 +382,49 @@ class DiasporaMessageParser:
     def __init__(self, contact_fetcher):
         self.contact_fetcher = contact_fetcher
 
-    def decode(self, raw, key):
+    def parse(self, raw):
         """
-        Extract the envelope XML from its wrapping.
+        Parse the envelope XML from its wrapping, so that it can be given to
+        both public_sender() and decode(). Raises MessageTooLarge if it is
+        too large.
         """
         # It has already been URL-decoded once by Flask
-        xml = unquote_plus(raw)
-        return self.process_salmon_envelope(xml, key)
+        return parse_quoted_xml(raw)
+
+    def decode(self, raw, key):
+        """
+        Extract the envelope XML from its wrapping (or take an envelope
+        already parsed by parse()). Raises MessageTooLarge if it is too
+        large.
+        """
+        if not isinstance(raw, etree._Element):
+            raw = self.parse(raw)
+        return self.process_salmon_envelope(raw, key)
+
+    def public_sender(self, raw):
+        """
+        Return the username of the claimed author of the envelope <raw> (or
+        an envelope already parsed by parse()), without verifying it, or None
+        if the envelope is encrypted.
+        """
+        if not isinstance(raw, etree._Element):
+            raw = self.parse(raw)
+        header = raw.find(".//{"+PROTOCOL_NS+"}header")
+        if header is None:
+            return None
+        return header.find(".//{"+PROTOCOL_NS+"}author_id").text
 
     def process_salmon_envelope(self, xml, key):
         """
-        Given the Slap XML, extract out the author and payload.
+        Given the Slap XML (or an already-parsed document), extract out the
+        author and payload.
         """
-        xml = xml.lstrip().encode("utf-8")
-        doc = etree.fromstring(xml)
+        if isinstance(xml, etree._Element):
+            doc = xml
+        else:
+            if not isinstance(xml, bytes):
+                xml = xml.encode("utf-8")
+            doc = parse_xml(xml.lstrip())
         header = doc.find(".//{"+PROTOCOL_NS+"}header")
         if header is not None:  # Public
             encrypted = False
@@ -272,9 +438,11 @@ class DiasporaMessageParser:
 
         sending_contact = self.contact_fetcher(sender).contact
         body = doc.find(
-            ".//{http://salmon-protocol.org/ns/magic-env}data").text
+            ".//{http://salmon-protocol.org/ns/magic-env}data"). \
+            text.encode("ascii")
         sig = doc.find(
             ".//{http://salmon-protocol.org/ns/magic-env}sig").text
+        doc = None  # The body is all that's needed now
         self.verify_signature(sending_contact, body, sig.encode('ascii'))
 
         if encrypted:
@@ -283,11 +451,11 @@ class DiasporaMessageParser:
                 header.find(".//aes_key").text.encode("ascii"))
 
             decrypter = AES.new(inner_key, AES.MODE_CBC, inner_iv)
-            body = b64decode(urlsafe_b64decode(body.encode("ascii")))
+            body = b64decode(urlsafe_b64decode(body))
             body = decrypter.decrypt(body)
             body = self.pkcs7_unpad(body)
         else:
-            body = urlsafe_b64decode(body.encode("ascii"))
+            body = urlsafe_b64decode(body)
 
         return body, sending_contact
 
@@ -296,14 +464,17 @@ class DiasporaMessageParser:
         Verify the signed XML elements to have confidence that the claimed
         author did actually generate this message.
         """
-        sig_contents = '.'.join([
-            payload,
+        # Hash the payload and the rest separately, to avoid copying the
+        # payload again
+        if not isinstance(payload, bytes):
+            payload = payload.encode("ascii")
+        sig_hash = SHA256.new(payload)
+        sig_hash.update(('.' + '.'.join([
             b64encode(b"application/xml").decode("ascii"),
             b64encode(b"base64url").decode("ascii"),
             b64encode(b"RSA-SHA256").decode("ascii")
-        ])
-        sig_hash = SHA256.new(sig_contents.encode("ascii"))
-        cipher = PKCSSign.new(RSA.importKey(contact.public_key))
+        ])).encode("ascii"))
+        cipher = PKCSSign.new(public_key_for(contact))
         assert(cipher.verify(sig_hash, urlsafe_b64decode(sig)))
 
     def parse_header(self, b64data, key):
@@ -343,7 +514,7 @@ class DiasporaMessageParser:
         encrypter = AES.new(key, AES.MODE_CBC, iv)
         padded = encrypter.decrypt(ciphertext)
         xml = self.pkcs7_unpad(padded)
-        doc = etree.fromstring(xml)
+        doc = parse_xml(xml)
         return doc
 
     def pkcs7_unpad(self, data):
@@ -370,32 +541,41 @@ class WebfingerRequest(object):
         self.secure = True
         self.normalise_email()
 
-    def fetch(self):
+    def fetch(self, template_url=None):
         """
         Fetch the WebFinger profile and return the XML document.
+        <template_url> is the server's WebFinger URL template, which is
+        fetched from the HostMeta if not supplied.
         """
-        template_url = self._get_template()
+        return etree.ElementTree(
+            parse_xml(self.fetch_document(template_url))
+        )
+
+    def fetch_document(self, template_url=None):
+        """
+        Fetch the WebFinger profile and return it unparsed, as fetch() does.
+        """
+        if not template_url:
+            template_url = self._get_template()
         target_url = re_sub(
             '\{uri\}',
-            quote_plus(
-                self.request_email.scheme + ':' + self.request_email.path
-            ),
+            quote_plus(self.account()),
             template_url
         )
-        return etree.parse(urlopen(target_url))
+        return urlopen(target_url, timeout=5).read()
+
+    def account(self):
+        """
+        The account URL being looked up (of form "acct:user@host").
+        """
+        return self.request_email.scheme + ':' + self.request_email.path
 
     def _get_template(self):
         """
         Given the HostMeta, extract the template URL for the main WebFinger
         information.
         """
-        tree = self.hostmeta.fetch()
-        return (
-            tree.xpath(
-                "//x:Link[@rel='lrdd']/@template",
-                namespaces={'x': 'http://docs.oasis-open.org/ns/xri/xrd-1.0'}
-            )
-        )[0]
+        return self.hostmeta.fetch_template()
 
     def normalise_email(self):
         """
@@ -461,12 +641,24 @@ class HostMeta(object):
         Fetch and return the HostMeta XML document.
         """
         conn = self._get_connection()
-        tree = etree.parse(conn)
+        tree = etree.parse(conn, xml_parser())
         if not self.secure:
             self.validate_signature(tree)
 
         return tree
 
+    def fetch_template(self):
+        """
+        Fetch the HostMeta and return the template URL for WebFinger
+        lookups on the host.
+        """
+        return (
+            self.fetch().xpath(
+                "//x:Link[@rel='lrdd']/@template",
+                namespaces={'x': 'http://docs.oasis-open.org/ns/xri/xrd-1.0'}
+            )
+        )[0]
+
     def validate_signature(self, tree):
         """
         If any part of fetching the HostMeta occurs insecurely (eg. over HTTP)
@@ -13,7 +13,6 @@ from flask import abort, Blueprint, current_app, jsonify, make_response, \
     request, url_for
 from json import dumps
 from lxml import etree
-from sqlalchemy.sql import desc
 from traceback import format_exc
 try:
     from urllib.parse import urlsplit
@@ -23,12 +22,15 @@ except:
 from pyaspora import db
 from pyaspora.contact.models import Contact
 from pyaspora.diaspora.actions import process_incoming_message
+from pyaspora.diaspora.inbound import process_public_queue
 from pyaspora.diaspora.models import DiasporaContact, DiasporaPost, \
     MessageQueue
-from pyaspora.diaspora.protocol import DiasporaMessageParser
+from pyaspora.diaspora.protocol import DiasporaMessageParser, \
+    max_message_bytes
 from pyaspora.post.models import Post, Share
 from pyaspora.user.models import User
 from pyaspora.user.session import require_logged_in_user
+from pyaspora.utils.pagination import paginate
 from pyaspora.utils.rendering import add_logged_in_user_to_data, \
     redirect, render_response, send_xml
 
@@ -169,14 +171,14 @@ def hcard(guid):
         **{'class': "url"}
     ).text = url_for('index', _external=True)
 
-    # FIXME - need to resize photos
     photos = {
-        "entity_photo": "300px",
-        "entity_photo_medium": "100px",
-        "entity_photo_small": "50px"
+        "entity_photo": 300,
+        "entity_photo_medium": 100,
+        "entity_photo_small": 50
     }
-    for k, v in photos.items():
-        src = diasp.photo_url()
+    for k, size in photos.items():
+        src = diasp.photo_url(size)
+        v = '{0}px'.format(size)
         dl = etree.SubElement(author, "dl", **{'class': k})
         etree.SubElement(dl, "dt").text = "Photo"
         dd = etree.SubElement(dl, "dd")
@@ -197,11 +199,20 @@ def hcard(guid):
     return send_xml(doc, content_type='text/html')
 
 
+def _check_message_size():
+    """
+    Reject a message that is too large before the form is read.
+    """
+    if (request.content_length or 0) > max_message_bytes():
+        abort(413, 'Message too large')
+
+
 @blueprint.route('/receive/users/<string:guid>/', methods=['POST'])
 def receive(guid):
     """
     Receive a Salmon Slap and save it for when the user logs in.
     """
+    _check_message_size()
     diasp = DiasporaContact.get_by_guid(guid)
     if diasp is None or not diasp.contact.user:
         abort(404, 'No such contact')
@@ -222,10 +233,27 @@ def receive(guid):
 @blueprint.route('/receive/public', methods=['POST'])
 def receive_public():
     """
-    Receive a public Salmon Slap and process it now.
+    Receive a public Salmon Slap and process it now. If the sender isn't
+    known yet, it is queued so that the incoming message worker can import
+    the sender.
     """
+    _check_message_size()
     dmp = DiasporaMessageParser(DiasporaContact.get_by_username)
-    ret, c_from = dmp.decode(request.form['xml'], None)
+    envelope = dmp.parse(request.form['xml'])
+    sender = dmp.public_sender(envelope)
+    if sender and not DiasporaContact.get_by_username(sender, False):
+        queue_item = MessageQueue()
+        queue_item.format = MessageQueue.PUBLIC_INCOMING
+        queue_item.body = request.form['xml'].encode('ascii')
+        db.session.add(queue_item)
+        db.session.commit()
+        return 'OK'
+
+    ret, c_from = dmp.decode(envelope, None)
+    envelope = None
+    # The handlers may commit, after which c_from can't be read once the
+    # session has been cleared below
+    c_from_id = c_from.id
     try:
         process_incoming_message(ret, c_from, None)
         return 'OK'
@@ -235,10 +263,11 @@ def receive_public():
         db.session.expunge_all()
         queue_item = MessageQueue()
         queue_item.local_user = None
-        queue_item.remote = None
+        queue_item.remote_id = c_from_id
         queue_item.format = MessageQueue.PUBLIC_INCOMING
         queue_item.body = request.form['xml'].encode('ascii')
         queue_item.error = err.encode('utf-8')
+        queue_item.attempts = 1
         db.session.add(queue_item)
         return 'Error', 400
     finally:
@@ -256,9 +285,13 @@ def json_feed(guid):
         abort(404, 'No such contact', force_status=True)
 
     feed_query = Post.Queries.public_wall_for_contact(contact.contact)
-    feed = db.session.query(Post).join(Share).filter(feed_query). \
-        order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id).limit(99)
+    feed, next_page = paginate(
+        db.session.query(Post).join(Share).filter(feed_query).
+        group_by(Post.id),
+        Post.thread_sort_time,
+        Post.id,
+        lambda p: (p.thread_sort_time, p.id)
+    )
 
     ret = []
     for post in feed:
@@ -279,7 +312,12 @@ def json_feed(guid):
         }
         ret.append(rep)
 
-    return jsonify(response)
+    # Diaspora expects a bare list, so the next page goes in a Link header
+    resp = make_response(dumps(ret))
+    resp.headers['Content-Type'] = 'application/json'
+    if next_page:
+        resp.headers['Link'] = '<{0}>; rel="next"'.format(next_page)
+    return resp
 
 
 @blueprint.route('/diaspora/run_queue', methods=['GET'])
@@ -312,24 +350,7 @@ def run_queue(_user):
 @blueprint.route('/diaspora/run_public_queue', methods=['GET'])
 @require_logged_in_user
 def run_public_queue(_user):
-    queue_items = db.session.query(MessageQueue).filter(
-        MessageQueue.Queries.pending_public_items()
-    ).order_by(MessageQueue.created_at)
-    for qi in queue_items:
-        if qi.error:
-            break
-
-        try:
-            qi.process_incoming()
-        except Exception:
-            err = format_exc()
-            qi.error = err.encode('utf-8')
-            current_app.logger.error(err)
-            db.session.add(qi)
-            break
-        else:
-            db.session.delete(qi)
-    db.session.commit()
+    process_public_queue()
     return redirect(url_for('feed.view'))
 
 
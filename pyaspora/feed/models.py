@@ -0,0 +1,340 @@
+"""
+Database models relating to the materialised per-user feed timeline.
+"""
+from __future__ import absolute_import, print_function
+
+from datetime import datetime
+from flask import current_app, url_for
+from json import loads
+from sqlalchemy import Column, DateTime, event, ForeignKey, Index, Integer
+from sqlalchemy.sql import and_, not_
+
+from pyaspora.database import db
+from pyaspora.utils.commands import command
+
+# The most SQL statements that showing a page of a feed may take, however
+# many posts are on it (see "check_feed_queries")
+FEED_QUERY_BUDGET = 15
+
+
+class FeedEntry(db.Model):
+    """
+    One top-level Post appearing in one local User's feed. This is a
+    denormalised copy of what the feed query over Shares, Subscriptions and
+    Interests would return, maintained as Posts are shared and subscriptions
+    change, so that a feed page can be read with a single index range scan.
+
+    Fields:
+        user_id - the User whose feed the Post appears in
+        post_id - the top-level Post that appears in the feed
+        thread_modified_at - copy of the Post's thread_sort_time, used to
+                             order the feed
+    """
+    __tablename__ = 'feed_entries'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True,
+                     index=True)
+    thread_modified_at = Column(DateTime(timezone=True), nullable=False)
+    __table_args__ = (
+        Index('ix_feed_entries_user_modified',
+              user_id, thread_modified_at, post_id),
+    )
+
+    @classmethod
+    def feed_for_user(cls, user):
+        """
+        The top-level Posts in User <user>'s feed. The caller should order
+        the results by thread_modified_at and post_id (which is indexed).
+        """
+        from pyaspora.post.models import Post
+        return db.session.query(Post). \
+            join(cls, cls.post_id == Post.id). \
+            filter(cls.user_id == user.id)
+
+    @classmethod
+    def _source_query(cls, user_ids=None, post_ids=None, author_ids=None):
+        """
+        The feed entries that should exist, derived from the Share,
+        Subscription and Interest tables: Posts shared with the user,
+        Posts the user's friends have put on their public walls, and public
+        Posts tagged with the user's interests.
+        """
+        from pyaspora.post.models import Post, Share
+        from pyaspora.roster.models import Subscription
+        from pyaspora.tag.models import Interest, PostTag
+        from pyaspora.user.models import User
+
+        def _base():
+            return db.session.query(
+                User.id, Post.id, Post.thread_sort_time
+            )
+
+        shared_with_user = _base(). \
+            select_from(Share). \
+            join(Post, Post.id == Share.post_id). \
+            join(User, User.contact_id == Share.contact_id). \
+            filter(and_(not_(Share.hidden), Post.parent_id == None))
+
+        friends_walls = _base(). \
+            select_from(Subscription). \
+            join(User, User.contact_id == Subscription.from_id). \
+            join(Share, Share.contact_id == Subscription.to_id). \
+            join(Post, and_(
+                Post.id == Share.post_id,
+                Post.author_id == Share.contact_id
+            )). \
+            filter(and_(
+                Share.public,
+                not_(Share.hidden),
+                Post.parent_id == None
+            ))
+
+        interests = _base(). \
+            select_from(Interest). \
+            join(User, User.contact_id == Interest.contact_id). \
+            join(PostTag, PostTag.tag_id == Interest.tag_id). \
+            join(Post, Post.id == PostTag.post_id). \
+            join(Share, Share.post_id == Post.id). \
+            filter(and_(
+                Share.public,
+                not_(Share.hidden),
+                Post.parent_id == None
+            ))
+
+        queries = []
+        for query in (shared_with_user, friends_walls, interests):
+            if user_ids is not None:
+                query = query.filter(User.id.in_(user_ids))
+            if post_ids is not None:
+                query = query.filter(Post.id.in_(post_ids))
+            if author_ids is not None:
+                query = query.filter(Post.author_id.in_(author_ids))
+            queries.append(query)
+
+        return queries[0].union(*queries[1:])
+
+    @classmethod
+    def rebuild(cls, user_ids=None, post_ids=None, author_ids=None):
+        """
+        Regenerate the feed entries from the underlying tables. The rebuild
+        can be restricted to the Users with IDs <user_ids>, the Posts with
+        IDs <post_ids> and/or the Posts authored by Contacts with IDs
+        <author_ids>; with no restrictions every feed is rebuilt. Pending
+        changes are flushed first. The caller must commit the session.
+        """
+        from pyaspora.post.models import Post
+
+        for ids in (user_ids, post_ids, author_ids):
+            if ids is not None and not ids:
+                return
+
+        db.session.flush()
+
+        stale = db.session.query(cls)
+        if user_ids is not None:
+            stale = stale.filter(cls.user_id.in_(user_ids))
+        if post_ids is not None:
+            stale = stale.filter(cls.post_id.in_(post_ids))
+        if author_ids is not None:
+            stale = stale.filter(cls.post_id.in_(
+                db.session.query(Post.id).
+                filter(Post.author_id.in_(author_ids)).
+                subquery()
+            ))
+        stale.delete(synchronize_session=False)
+
+        source = cls._source_query(user_ids, post_ids, author_ids)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'post_id', 'thread_modified_at'],
+            source.statement
+        ))
+
+    @classmethod
+    def refresh_posts(cls, posts):
+        """
+        Bring the feed entries for <posts> up to date after they have been
+        shared, hidden or had their privacy changed.
+        """
+        db.session.flush()  # So new Posts have IDs
+        cls.rebuild(post_ids=[p.id for p in posts if not p.parent_id])
+
+    @classmethod
+    def thread_modified(cls, post):
+        """
+        Copy the new modification time of the top-level Post <post> to its
+        feed entries.
+        """
+        if post.id is None:
+            return  # Not yet written out, so no entries yet
+        db.session.query(cls). \
+            filter(cls.post_id == post.id). \
+            update(
+                {'thread_modified_at': post.thread_modified_at},
+                synchronize_session=False
+            )
+
+
+@command('rebuild_feeds')
+def rebuild_feeds():
+    """
+    Regenerate every user's feed timeline from the existing tables.
+    """
+    FeedEntry.rebuild()
+    db.session.commit()
+    print('Rebuilt {0} feed entries'.format(
+        db.session.query(FeedEntry).count()
+    ))
+
+
+@command('benchmark_feed')
+def benchmark_feed(email, password, pages='5'):
+    """
+    Fetch the first <pages> pages of the feed of the User with <email>, and
+    report how many bytes of MimePart data were read for each, from the
+    database (whether loaded with the parts or afterwards) and from the blob
+    store.
+    """
+    from pyaspora.content.blobs import blob_store
+    from pyaspora.content.models import MimePart
+    loaded = {'database': 0, 'blob': 0}
+
+    def _count(values, source='database'):
+        loaded[source] += sum(
+            len(v) for v in values if isinstance(v, (bytes, type(u'')))
+        )
+
+    def _on_load(target, context):
+        _count(target.__dict__.values())
+
+    def _on_refresh(target, context, attrs):
+        _count(target.__dict__.get(a) for a in (attrs or ()))
+
+    # Bodies loaded in bulk and those read from the blob store don't cause
+    # events, so the calls are wrapped for the duration of the benchmark
+    load_bodies = MimePart.__dict__['load_bodies']
+    store = blob_store()
+    store_get = store.get
+
+    def _load_bodies(cls, parts):
+        parts = [p for p in parts if '_body' not in p.__dict__]
+        load_bodies.__get__(None, cls)(parts)
+        _count(p.__dict__.get('_body') for p in parts)
+
+    def _get(key):
+        body = store_get(key)
+        _count([body], 'blob')
+        return body
+
+    event.listen(MimePart, 'load', _on_load)
+    event.listen(MimePart, 'refresh', _on_refresh)
+    MimePart.load_bodies = classmethod(_load_bodies)
+    store.get = _get
+    try:
+        client = current_app.test_client()
+        client.post('/users/login', data={
+            'email': email,
+            'password': password
+        })
+        url = url_for('feed.view', alt='json')
+        for page in range(int(pages)):
+            loaded.update(database=0, blob=0)
+            resp = client.get(url)
+            if resp.status_code != 200:
+                raise SystemExit('Could not fetch feed: HTTP {0}'.format(
+                    resp.status_code))
+            data = loads(resp.data.decode('utf-8'))
+            print('Page {0}: {1} posts, {2} bytes of parts loaded from the '
+                  'database, {3} bytes of bodies from the blob store'.format(
+                      page + 1, len(data['feed']), loaded['database'],
+                      loaded['blob']))
+            url = data['next']
+            if not url:
+                break
+    finally:
+        event.remove(MimePart, 'load', _on_load)
+        event.remove(MimePart, 'refresh', _on_refresh)
+        MimePart.load_bodies = load_bodies
+        del store.get
+
+
+@command('check_feed_queries')
+def check_feed_queries(posts='100', budget=None):
+    """
+    Check that fetching a page of <posts> posts from the feed view takes no
+    more SQL statements than <budget> (FEED_QUERY_BUDGET by default), and
+    the same number as a page a tenth of the size, so that the number of
+    statements doesn't grow with the number of posts. A test user and posts,
+    with comments and shares, are made for the check and then thrown away.
+    """
+    from pyaspora.contact.models import Contact
+    from pyaspora.content.models import MimePart
+    from pyaspora.post.models import Post, Share
+    from pyaspora.user.models import User
+
+    posts = int(posts)
+    budget = int(budget) if budget else FEED_QUERY_BUDGET
+    small_limit = max(posts // 10, 2)
+    try:
+        viewer = User()
+        viewer.email = 'check-feed-queries@localhost'
+        viewer.contact.realname = 'Viewer'
+        viewer.generate_keypair('check')
+        viewer.activated = datetime.now()
+        author = Contact(realname='Author', public_key='-')
+        db.session.add(author)
+        top_posts = []
+        for i in range(posts):
+            post = Post(author=author)
+            post.add_part(MimePart(
+                type='text/x-markdown',
+                body='Post *{0}*'.format(i).encode('utf-8'),
+                text_preview=None
+            ), inline=True, order=0)
+            db.session.add(Share(contact=viewer.contact, post=post,
+                                 public=bool(i % 2)))
+            db.session.add(Share(contact=author, post=post, public=True))
+            if i % 2 == 0:
+                comment = Post(author=viewer.contact, parent=post)
+                reply = Post(author=author, parent=comment)
+                for child in (comment, reply):
+                    db.session.add(Share(contact=author, post=child,
+                                         public=True))
+            post.thread_modified()
+            top_posts.append(post)
+        FeedEntry.refresh_posts(top_posts)
+
+        # The test client shares this session, so sees the uncommitted posts
+        client = current_app.test_client()
+        client.post(url_for('users.process_login'), data={
+            'email': viewer.email,
+            'password': 'check'
+        })
+
+        def _statements(limit):
+            # So that nothing is already loaded, as in a new request
+            db.session.expire_all()
+            executed = []
+
+            def _count(*args):
+                executed.append(args[2])
+
+            event.listen(db.engine, 'before_cursor_execute', _count)
+            try:
+                resp = client.get(url_for('feed.view', alt='json',
+                                          limit=limit))
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', _count)
+            if resp.status_code != 200:
+                raise SystemExit('Could not fetch feed: HTTP {0}'.format(
+                    resp.status_code))
+            return len(executed)
+
+        small = _statements(small_limit)
+        large = _statements(posts)
+    finally:
+        db.session.rollback()
+
+    print('{0} posts: {1} statements; {2} posts: {3} statements; '
+          'budget {4}'.format(small_limit, small, posts, large, budget))
+    if large > budget or large != small:
+        raise SystemExit('Showing a feed takes too many statements')
@@ -10,8 +10,16 @@ Display the user's "feed".
 {{button_form(logged_in.actions.new_post, 'Post something new', method='get')}}
 {{button_form(logged_in.link, 'View/edit profile', method='get')}}
 
+{% if queue %}
+    <p>You have new items from other servers waiting.</p>
+    {{button_form(queue, 'Load new items', method='get')}}
+{% endif %}
+
 {% if feed %}
     {{show_feed(feed, logged_in)}}
+    {% if next %}
+        {{button_form(next, 'Older posts', method='get')}}
+    {% endif %}
 {% else %}
     <p>Your feed is empty. You can change your profile tags to show posts
     on topics that interest you.</p>
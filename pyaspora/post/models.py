@@ -1,14 +1,17 @@
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
 from datetime import datetime
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer
-from sqlalchemy.orm import backref, contains_eager, relationship
-from sqlalchemy.sql import and_, not_
+from dateutil.tz import tzutc
+from sqlalchemy import Boolean, Column, DateTime, event, ForeignKey, Integer
+from sqlalchemy.orm import backref, column_property, contains_eager, \
+    relationship
+from sqlalchemy.sql import and_, not_, or_
 from sqlalchemy.sql.expression import func
 
 from pyaspora.content.models import MimePart
 from pyaspora.contact.models import Contact
 from pyaspora.database import db
+from pyaspora.utils.commands import command
 
 
 class Share(db.Model):
@@ -94,11 +97,19 @@ class Post(db.Model):
         parent - if this Post is a comment on another Post, this links to the
                  parent Post. May be None.
         parent_id - the database primary key for the above
+        root_post - if this Post is a comment, the top-level Post of the
+                    thread it is in (following parent links to the top).
+                    None for top-level posts
+        root_id - the database primary key for the above
         thread_modified_at - last modification of the post or children, only
                              set on posts with no parent (top-level items)
+        thread_sort_time - thread_modified_at, or created_at if that isn't
+                           set. Feeds of Posts are ordered by this
         shares - Shares of this Post (occurrences in feeds/on walls)
         parts - PostParts that this Post consists of (the Post contents)
         children - Posts that have this post as the parent
+        public_shares - how many of the Post's Shares are public. This is
+                        kept so that is_public() needn't query the Shares
     """
     __tablename__ = 'posts'
     id = Column(Integer, primary_key=True)
@@ -106,14 +117,22 @@ class Post(db.Model):
                        nullable=False, index=True)
     parent_id = Column(Integer, ForeignKey('posts.id'), nullable=True,
                        default=None, index=True)
+    root_id = Column(Integer, ForeignKey('posts.id'), nullable=True,
+                     default=None, index=True)
     created_at = Column(DateTime(timezone=True),
                         nullable=False, default=func.now())
     thread_modified_at = Column(DateTime(timezone=True), nullable=True)
+    thread_sort_time = column_property(
+        func.coalesce(thread_modified_at, created_at))
+    public_shares = Column(Integer, nullable=False, default=0, index=True)
 
     author = relationship(Contact, backref='posts')
     parts = relationship(PostPart, backref='post', order_by=PostPart.order)
-    children = relationship('Post',
-                            backref=backref('parent', remote_side=[id]))
+    parent = relationship('Post', remote_side=[id], foreign_keys=[parent_id],
+                          back_populates='children')
+    children = relationship('Post', foreign_keys=[parent_id],
+                            back_populates='parent')
+    root_post = relationship('Post', remote_side=[id], foreign_keys=[root_id])
     shares = relationship(Share, backref='post')
 
     class Queries:
@@ -153,6 +172,13 @@ class Post(db.Model):
                 Post.parent_id == None
             )
 
+        @classmethod
+        def in_threads(cls, root_ids):
+            return or_(
+                Post.id.in_(root_ids),
+                Post.root_id.in_(root_ids)
+            )
+
     @classmethod
     def get(cls, postid):
         """
@@ -181,8 +207,94 @@ class Post(db.Model):
         """
         List of child posts that the Contact <contact> is permitted to view
         """
-        return [child for child in self.children
-                if child.has_permission_to_view(contact)]
+        children, _ = self.viewable_children_for_posts([self.id], contact)
+        return [child for child, share in children.get(self.id, [])]
+
+    @classmethod
+    def viewable_children_for_posts(cls, post_ids, contact=None):
+        """
+        Bulk version of viewable_children() that resolves the children of all
+        the Posts with IDs <post_ids> in a fixed number of queries. Returns a
+        tuple of two dicts. The first maps each parent Post ID to a list of
+        (child, share) pairs for the children that <contact> is permitted to
+        view, where <share> is the child's Share with <contact> (or None). The
+        second maps each child Post ID to a list of all its Shares.
+        """
+        if not post_ids:
+            return {}, {}
+
+        children = db.session.query(cls). \
+            filter(cls.parent_id.in_(post_ids)).all()
+        return cls._viewable_by_parent(children, contact)
+
+    @classmethod
+    def viewable_descendants_for_posts(cls, posts, contact=None):
+        """
+        As viewable_children_for_posts(), but resolves the children of every
+        Post in the threads containing <posts>, so that the whole of each
+        thread is fetched in a fixed number of queries however deep it is.
+        Children whose parent may not be viewed are in the result, so it
+        should be walked down from <posts>.
+        """
+        if not posts:
+            return {}, {}
+
+        root_ids = set(p.root().id for p in posts)
+        descendants = db.session.query(cls).filter(or_(
+            cls.root_id.in_(root_ids),
+            and_(cls.root_id == None, cls.parent_id.in_(root_ids))
+        )).all()
+
+        # Comments made before thread roots were stored (and not yet filled
+        # in by "backfill_thread_roots") are found a level at a time instead
+        found = set(p.id for p in descendants)
+        unrooted = [p.id for p in descendants if p.root_id is None]
+        while unrooted:
+            children = [
+                p for p in db.session.query(cls).
+                filter(cls.parent_id.in_(unrooted))
+                if p.id not in found
+            ]
+            descendants.extend(children)
+            found.update(p.id for p in children)
+            unrooted = [p.id for p in children]
+        return cls._viewable_by_parent(descendants, contact)
+
+    @classmethod
+    def _viewable_by_parent(cls, children, contact):
+        """
+        Group the Posts <children> that <contact> is permitted to view by
+        parent, fetching their Shares, as viewable_children_for_posts()
+        returns.
+        """
+        result = {}
+        if not children:
+            return result, {}
+
+        shares = dict((c.id, []) for c in children)
+        for share in Share.get_for_posts(list(shares.keys())):
+            shares[share.post_id].append(share)
+
+        for child in children:
+            child_shares = shares[child.id]
+            share = None
+            if contact:
+                share = [s for s in child_shares
+                         if s.contact_id == contact.id]
+                share = share[0] if share else None
+
+            # Same rules as has_permission_to_view()
+            if share:
+                permitted = not share.hidden
+            elif contact and contact.id == child.author_id:
+                permitted = True
+            else:
+                permitted = child.is_public()
+
+            if permitted:
+                result.setdefault(child.parent_id, []).append((child, share))
+
+        return result, shares
 
     def add_part(self, mime_part, inline=False, order=1):
         """
@@ -198,10 +310,21 @@ class Post(db.Model):
         """
         Returns true if anybody has made this Post public.
         """
-        return db.session.query(Share).filter(and_(
-            Share.public,
-            Share.post == self
-        )).first()
+        return bool(self.public_shares)
+
+    def public_share_changed(self, public):
+        """
+        Keep count of a Share of this Post being made <public> (or private),
+        or being created public. Requires the caller commit the session.
+        """
+        change = 1 if public else -1
+        if self.id is None:
+            self.public_shares = (self.public_shares or 0) + change
+            return
+        # Counted in the database, so that concurrent changes aren't lost.
+        # Flushing reloads the count the next time it is read.
+        self.public_shares = Post.public_shares + change
+        db.session.flush()
 
     def author_made_public(self):
         """
@@ -226,6 +349,64 @@ class Post(db.Model):
         else:
             return True
 
+    @classmethod
+    def can_change_privacy_for_posts(cls, posts, known_shares=None):
+        """
+        Bulk version of can_change_privacy() for all the Posts in <posts>,
+        using a fixed number of queries. <known_shares> may map Post IDs to
+        lists of all their Shares, where these have already been fetched.
+        Returns a dict mapping each Post ID to a dict of new privacy state
+        (True or False) to whether that change is permitted.
+        """
+        from pyaspora.diaspora.models import DiasporaPost
+
+        if not posts:
+            return {}
+        known_shares = known_shares or {}
+        post_ids = [p.id for p in posts]
+
+        # Parents must be public for the post to go public
+        public_ids = set()
+        parent_ids = set(p.parent_id for p in posts if p.parent_id)
+        for parent_id in list(parent_ids):
+            if parent_id in known_shares:
+                parent_ids.remove(parent_id)
+                if any(s.public for s in known_shares[parent_id]):
+                    public_ids.add(parent_id)
+        if parent_ids:
+            public_ids.update(r[0] for r in db.session.query(cls.id).
+                              filter(and_(
+                                  cls.id.in_(parent_ids),
+                                  cls.public_shares > 0
+                              )))
+
+        # Children must all be private for the post to go private
+        public_children_of = set(
+            r[0] for r in db.session.query(cls.parent_id).
+            filter(and_(
+                cls.parent_id.in_(post_ids),
+                cls.public_shares > 0
+            )).distinct()
+        )
+
+        # Posts that have been federated generally can't change
+        federated = set(
+            d.post_id for d in db.session.query(DiasporaPost).
+            filter(DiasporaPost.post_id.in_(post_ids))
+            if not d.can_change_privacy()
+        )
+
+        result = {}
+        for post in posts:
+            permitted = post.id not in federated
+            result[post.id] = {
+                True: permitted and not (
+                    post.parent_id and post.parent_id not in public_ids
+                ),
+                False: permitted and post.id not in public_children_of,
+            }
+        return result
+
     def _send_to_remotes(self, contacts):
         """
         Arrange to send this post to contacts on the remote node.
@@ -250,14 +431,19 @@ class Post(db.Model):
         doesn't share the post if the Contact already has this Post shared
         with them.
         """
+        from pyaspora.feed.models import FeedEntry
         new_shares = []
         for contact in contacts:
             if not self.shared_with(contact):
                 new_shares.append(contact)
                 db.session.add(Share(contact=contact, post=self,
                                      public=show_on_wall))
+                if show_on_wall:
+                    self.public_share_changed(True)
                 if contact.user and contact.id != self.author_id:
                     contact.user.notify_event(commit=False)
+        if new_shares:
+            FeedEntry.refresh_posts([self])
         if self.author.user:
             # Only announce locally-generated content
             self._send_to_remotes(new_shares)
@@ -276,6 +462,10 @@ class Post(db.Model):
         """
         The top-level post that started this thread.
         """
+        if self.root_post or not self.parent_id:
+            return self.root_post or self
+
+        # Not stored yet (see "backfill_thread_roots"), so follow the parents
         post = self
         while post.parent:
             post = post.parent
@@ -286,7 +476,81 @@ class Post(db.Model):
         Mark this thread as having been modified. This makes it "bubble up" in
         contact feeds. Requires the caller commit the session.
         """
+        from pyaspora.feed.models import FeedEntry
         post = self.root()
-        post.thread_modified_at = func.now()
+        # Set from Python, so that the time read back matches the value
+        # written exactly, as feed paging cursors rely on
+        post.thread_modified_at = datetime.now(tzutc())
         if post.id != self.id:
             db.session.add(post)
+        FeedEntry.thread_modified(post)
+
+
+@event.listens_for(Post.parent, 'set')
+def _parent_changed(post, parent, old_parent, initiator):
+    """
+    Comments are in the same thread as the Post they comment on.
+    """
+    post.root_post = parent.root() if parent is not None else None
+
+
+@command('check_public_flags')
+def check_public_flags(fix=False):
+    """
+    Check that each Post's count of public Shares matches the Shares, and
+    correct any that don't if an argument is given (for example, to fill in
+    the counts after upgrading).
+    """
+    counts = dict(
+        db.session.query(Share.post_id, func.count(Share.contact_id)).
+        filter(Share.public).group_by(Share.post_id)
+    )
+    wrong = 0
+    for post_id, public_shares in db.session.query(
+            Post.id, Post.public_shares):
+        expected = counts.get(post_id, 0)
+        if public_shares != expected:
+            wrong += 1
+            print('Post {0} counts {1} public shares, but has {2}'.format(
+                post_id, public_shares, expected))
+            if fix:
+                db.session.query(Post).filter(Post.id == post_id). \
+                    update({'public_shares': expected},
+                           synchronize_session=False)
+    db.session.commit()
+    print('{0} posts {1}'.format(wrong, 'corrected' if fix else 'wrong'))
+
+
+@command('backfill_thread_roots')
+def backfill_thread_roots(batch_size='1000'):
+    """
+    Work out the top-level Post of each thread from the parent links and
+    store it on every comment in the thread, for example after upgrading.
+    """
+    batch_size = int(batch_size)
+    parents = dict(db.session.query(Post.id, Post.parent_id))
+    stored = dict(db.session.query(Post.id, Post.root_id))
+
+    roots = {}
+    for post_id, parent_id in parents.items():
+        path = []
+        while parent_id and post_id not in roots:
+            path.append(post_id)
+            post_id, parent_id = parent_id, parents.get(parent_id)
+        root_id = roots.get(post_id, post_id)
+        for p in path:
+            roots[p] = root_id
+
+    by_root = {}
+    for post_id, root_id in roots.items():
+        if stored[post_id] != root_id:
+            by_root.setdefault(root_id, []).append(post_id)
+    changed = 0
+    for root_id, post_ids in by_root.items():
+        for i in range(0, len(post_ids), batch_size):
+            batch = post_ids[i:i + batch_size]
+            db.session.query(Post).filter(Post.id.in_(batch)). \
+                update({'root_id': root_id}, synchronize_session=False)
+            changed += len(batch)
+    db.session.commit()
+    print('Stored the thread root of {0} posts'.format(changed))
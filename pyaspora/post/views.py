@@ -5,10 +5,13 @@ from json import dumps
 from sqlalchemy.sql import and_, not_
 
 from pyaspora.content.models import MimePart
-from pyaspora.content.rendering import render, renderer_exists
+from pyaspora.content.rendering import prerender, render_many, \
+    renderer_exists
+from pyaspora.content.uploads import part_from_upload
 from pyaspora.contact.models import Contact
 from pyaspora.contact.views import json_contact
 from pyaspora.database import db
+from pyaspora.feed.models import FeedEntry
 from pyaspora.post.models import Post, PostPart, Share
 from pyaspora.post.targets import target_list, targets_by_name
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
@@ -30,10 +33,33 @@ def _get_cached(cache, entry_type, entry_id):
 def _base_cache():
     return {
         'contact': {},
-        'post': {}
+        'post': {},
+        'children': {},
+        'shares': {},
+        'privacy': []
     }
 
 
+def _prefetch_children(cache, posts, viewing_as=None):
+    """
+    Resolve the children of <posts> (and all their descendants) that
+    'viewing_as' may see into the cache. Whole threads are fetched at once
+    and the tree is put together here, so that the number of queries doesn't
+    depend on the number of posts or how deeply they are nested.
+    """
+    posts = [p for p in posts if p.id not in cache['children']]
+    children, shares = Post.viewable_descendants_for_posts(posts, viewing_as)
+    cache['shares'].update(shares)
+    post_ids = [p.id for p in posts]
+    while post_ids:
+        post_id = post_ids.pop()
+        cache['children'][post_id] = sorted(
+            children.get(post_id, []),
+            key=lambda child_and_share: child_and_share[0].created_at
+        )
+        post_ids.extend(p.id for p, s in cache['children'][post_id])
+
+
 def json_posts(posts_and_shares, viewing_as=None, show_shares=False):
     """
     Run a list of (post, share) pairs through json_post, giving a list
@@ -41,6 +67,7 @@ def json_posts(posts_and_shares, viewing_as=None, show_shares=False):
     calling json_post() repeatedly as data is cached.
     """
     cache = _base_cache()
+    _prefetch_children(cache, [p for p, s in posts_and_shares], viewing_as)
     res = [
         json_post(p, viewing_as, s, cache=cache)
         for p, s in posts_and_shares
@@ -58,8 +85,6 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
     """
     c = cache or _base_cache()
 
-    sorted_children = sorted(post.viewable_children(viewing_as),
-                             key=lambda p: p.created_at)
     data = _get_cached(c, 'post', post.id)
     data.update({
         'id': post.id,
@@ -78,13 +103,11 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
         'shares': None
     })
     if children:
+        if post.id not in c['children']:
+            _prefetch_children(c, [post], viewing_as)
         data['children'] = [
-            json_post(
-                p,
-                viewing_as,
-                p.shared_with(viewing_as) if viewing_as else None,
-                cache=c
-            ) for p in sorted_children
+            json_post(p, viewing_as, s, cache=c)
+            for p, s in c['children'][post.id]
         ]
     if viewing_as:
         data['actions']['comment'] = url_for('posts.comment',
@@ -96,14 +119,8 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
         if share and viewing_as and share.contact_id == viewing_as.id:
             data['actions']['hide'] = url_for('posts.hide',
                                               post_id=post.id, _external=True)
-            if share.public and post.can_change_privacy(False):
-                data['actions']['unmake_public'] = \
-                    url_for('posts.set_public',
-                            post_id=post.id, toggle='0', _external=True)
-            elif post.can_change_privacy(True):
-                data['actions']['make_public'] = \
-                    url_for('posts.set_public',
-                            post_id=post.id, toggle='1', _external=True)
+            # Privacy actions are worked out in bulk by _fill_cache
+            c['privacy'].append((post, share))
 
     if not cache:
         _fill_cache(c, bool(share))
@@ -118,17 +135,38 @@ def _fill_cache(c, show_shares=False):
         for post_tag in PostTag.get_tags_for_posts(post_ids):
             c['post'][post_tag.post_id]['tags'].append(json_tag(post_tag.tag))
         post_parts = PostPart.get_parts_for_posts(post_ids). \
-            order_by(PostPart.order)
-        for post_part in post_parts:
-            c['post'][post_part.post_id]['parts'].append(json_part(post_part))
+            order_by(PostPart.order).all()
+        for post_part, part_repr in zip(post_parts, json_parts(post_parts)):
+            c['post'][post_part.post_id]['parts'].append(part_repr)
         if show_shares:
-            for post_share in Share.get_for_posts(post_ids):
-                post_id = post_share.post_id
-                if not c['post'][post_id]['shares']:
-                    c['post'][post_id]['shares'] = []
-                c['post'][post_id]['shares'].append(
-                    json_share(post_share, cache=c)
-                )
+            # Children's shares were fetched when resolving visibility
+            missing = [i for i in post_ids if i not in c['shares']]
+            if missing:
+                for post_share in Share.get_for_posts(missing):
+                    c['shares'].setdefault(post_share.post_id, []). \
+                        append(post_share)
+            for post_id in post_ids:
+                for post_share in c['shares'].get(post_id, []):
+                    if not c['post'][post_id]['shares']:
+                        c['post'][post_id]['shares'] = []
+                    c['post'][post_id]['shares'].append(
+                        json_share(post_share, cache=c)
+                    )
+    if c['privacy']:
+        permitted = Post.can_change_privacy_for_posts(
+            [p for p, s in c['privacy']],
+            c['shares']
+        )
+        for post, share in c['privacy']:
+            actions = c['post'][post.id]['actions']
+            if share.public and permitted[post.id][False]:
+                actions['unmake_public'] = \
+                    url_for('posts.set_public',
+                            post_id=post.id, toggle='0', _external=True)
+            elif permitted[post.id][True]:
+                actions['make_public'] = \
+                    url_for('posts.set_public',
+                            post_id=post.id, toggle='1', _external=True)
     if c['contact']:
         for contact in Contact.get_many(c['contact'].keys()):
             c['contact'][contact.id].update(json_contact(contact))
@@ -151,17 +189,33 @@ def json_part(part):
     """
     Turn a PostPart into a sensible format for serialisation.
     """
-    url = url_for('content.raw', part_id=part.mime_part.id, _external=True)
-    return {
-        'inline': part.inline,
-        'mime_type': part.mime_part.type,
-        'text_preview': part.mime_part.text_preview,
-        'link': url,
-        'body': {
-            'text': render(part, 'text/plain', url),
-            'html': render(part, 'text/html', url),
+    return json_parts([part])[0]
+
+
+def json_parts(parts):
+    """
+    Run a list of PostParts through json_part. This is more efficient than
+    calling json_part() repeatedly as the parts are rendered together.
+    """
+    urls = [
+        url_for('content.raw', part_id=part.mime_part.id, _external=True)
+        for part in parts
+    ]
+    texts = render_many(parts, 'text/plain', urls)
+    htmls = render_many(parts, 'text/html', urls)
+    return [
+        {
+            'inline': part.inline,
+            'mime_type': part.mime_part.type,
+            'text_preview': part.mime_part.text_preview,
+            'link': urls[i],
+            'body': {
+                'text': texts[i],
+                'html': htmls[i],
+            }
         }
-    }
+        for i, part in enumerate(parts)
+    ]
 
 
 @blueprint.route('/<int:post_id>/share', methods=['GET'])
@@ -238,6 +292,7 @@ def hide(post_id):
 
     share.hidden = True
     db.session.add(share)
+    FeedEntry.refresh_posts([share.post])
     db.session.commit()
 
     return redirect(url_for('feed.view', _external=True))
@@ -258,7 +313,9 @@ def set_public(post_id, toggle):
 
     if share.public != toggle:
         share.public = toggle
+        post.public_share_changed(toggle)
         db.session.add(share)
+        FeedEntry.refresh_posts([post])
         if toggle:
             # If it's going public, it'll be visible to more people
             post.thread_modified()
@@ -387,13 +444,9 @@ def create(_user):
         attachment = request.files.get('attachment', None)
         if attachment and attachment.filename:
             check_attachment_is_safe(attachment)
-            attachment_part = MimePart(
-                type=attachment.mimetype,
-                body=attachment.stream.read(),
-                text_preview=attachment.filename
-            )
+            attachment_part = part_from_upload(attachment)
             post.add_part(attachment_part, order=1,
-                          inline=bool(renderer_exists(attachment.mimetype)))
+                          inline=bool(renderer_exists(attachment_part.type)))
 
     post.thread_modified()
 
@@ -401,6 +454,8 @@ def create(_user):
     db.session.add(post)
     db.session.commit()
 
+    prerender(post.parts)
+
     targets_by_name[target['type']].make_shares(post, target['id'])
     db.session.commit()
 
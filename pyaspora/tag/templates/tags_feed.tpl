@@ -9,6 +9,9 @@ Display the feed of posts about a particular Tag topic.
 
 {% if feed %}
     {{show_feed(feed)}}
+    {% if next %}
+        {{button_form(next, 'Older posts', method='get')}}
+    {% endif %}
 {% else %}
     <p>No posts for this topic.</p>
 {% endif %}
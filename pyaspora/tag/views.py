@@ -4,11 +4,11 @@ Views relating to tags.
 from __future__ import absolute_import
 
 from flask import Blueprint, url_for
-from sqlalchemy.sql import desc
 
 from pyaspora.database import db
 from pyaspora.tag.models import PostTag, Tag
 from pyaspora.user.session import require_logged_in_user
+from pyaspora.utils.pagination import paginate
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
     render_response
 
@@ -42,14 +42,18 @@ def feed(tag_name, _user):
 
     data = json_tag(tag)
 
-    posts = db.session.query(Post). \
-        join(PostTag). \
-        join(Tag). \
-        join(Share). \
-        filter(Tag.Queries.public_posts_for_tags([tag.id])). \
-        order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id). \
-        limit(100)
+    posts, data['next'] = paginate(
+        db.session.query(Post).
+        join(PostTag).
+        join(Tag).
+        join(Share).
+        filter(Tag.Queries.public_posts_for_tags([tag.id])).
+        group_by(Post.id),
+        Post.thread_sort_time,
+        Post.id,
+        lambda p: (p.thread_sort_time, p.id),
+        default_limit=100
+    )
 
     data['feed'] = json_posts([(p, None) for p in posts])
 
@@ -5,6 +5,7 @@ from __future__ import absolute_import
 
 from Crypto.PublicKey import RSA
 from datetime import datetime, timedelta
+from flask import current_app
 from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 from sqlalchemy.orm import backref, joinedload, relationship
 from sqlalchemy.sql.expression import func
@@ -30,6 +31,9 @@ class User(db.Model):
         activated - None until the user activates their account by email.
                     Afterwards a DateTime of activation.
         groups - a list of SubscriptionGroups the user owns
+        escrowed_key - if key escrow is enabled, a copy of the private key
+                       encrypted with the node's escrow passphrase, so that
+                       background workers can decrypt incoming messages
     """
 
     __tablename__ = 'users'
@@ -41,6 +45,7 @@ class User(db.Model):
     notification_hours = Column(Integer, nullable=True, default=None)
     last_notified = Column(DateTime(timezone=True), nullable=True,
                            default=None)
+    escrowed_key = Column(String, nullable=True, default=None)
 
     contact = relationship(Contact, single_parent=True,
                            backref=backref('user', uselist=False))
@@ -111,6 +116,52 @@ class User(db.Model):
         except (ValueError, IndexError, TypeError):
             return None
 
+    @classmethod
+    def _escrow_passphrase(cls):
+        return current_app.config.get('KEY_ESCROW_PASSPHRASE', None) or \
+            current_app.secret_key
+
+    def escrow_key(self, unlocked_key):
+        """
+        If the node has key escrow enabled (the KEY_ESCROW setting), store a
+        copy of the private key <unlocked_key> protected by the node's escrow
+        passphrase rather than the user's password. Otherwise any copy held
+        is removed. The caller must commit the session.
+        """
+        if current_app.config.get('KEY_ESCROW', False):
+            self.escrowed_key = unlocked_key.exportKey(
+                format='PEM',
+                pkcs=1,
+                passphrase=self._escrow_passphrase()
+            ).decode("ascii")
+        else:
+            self.escrowed_key = None
+
+    def has_escrowed_key(self):
+        """
+        Whether background workers can use this user's private key.
+        """
+        return bool(
+            current_app.config.get('KEY_ESCROW', False) and self.escrowed_key
+        )
+
+    def unlock_escrowed_key(self):
+        """
+        Return the private key held in escrow, or None if key escrow is
+        disabled or no (usable) key is held.
+        """
+        if not current_app.config.get('KEY_ESCROW', False):
+            return None
+        if not self.escrowed_key:
+            return None
+        try:
+            return RSA.importKey(
+                self.escrowed_key,
+                passphrase=self._escrow_passphrase()
+            )
+        except (ValueError, IndexError, TypeError):
+            return None
+
     def change_password(self, old_pw, new_pw):
         """
         Change the password on the key from <old_pw> to <new_pw>. Throws a
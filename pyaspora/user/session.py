@@ -6,10 +6,11 @@ is active.
 from __future__ import absolute_import
 
 from functools import wraps
-from Crypto.PublicKey import RSA
 from flask import current_app, session
 
+from pyaspora.database import db
 from pyaspora.user.models import User
+from pyaspora.utils.keys import unlock_session_key
 from pyaspora.utils.rendering import abort
 
 
@@ -27,9 +28,10 @@ def logged_in_user(fetch=True):
         return None
 
     try:
-        unlocked_key = RSA.importKey(
+        unlocked_key = unlock_session_key(
+            user_id,
             private_key,
-            passphrase=current_app.secret_key
+            current_app.secret_key
         )
     except (ValueError, IndexError, TypeError):
         return None
@@ -74,6 +76,13 @@ def log_in_user(email, password):
         return None
 
     user._unlocked_key = key
+    # Keep the escrowed copy of the key in line with the node's settings
+    escrow = current_app.config.get('KEY_ESCROW', False)
+    if (escrow and not user.unlock_escrowed_key()) or \
+            (user.escrowed_key and not escrow):
+        user.escrow_key(key)
+        db.session.commit()
+
     session['user_id'] = user.id
     session['key'] = key.exportKey(
         format='PEM',
@@ -8,9 +8,12 @@ from flask import Blueprint, current_app, request, session, url_for
 from json import dumps as json_dumps
 
 from pyaspora.contact.views import json_contact
+from pyaspora.content.images import make_variants
 from pyaspora.content.models import MimePart
 from pyaspora.content.rendering import renderer_exists
+from pyaspora.content.uploads import part_from_upload, upload_type
 from pyaspora.database import db
+from pyaspora.feed.models import FeedEntry
 from pyaspora.tag.models import Tag
 from pyaspora.user import models
 from pyaspora.user.session import log_in_user, logged_in_user, \
@@ -213,16 +216,13 @@ def edit(_user):
         order += 1
         check_attachment_is_safe(attachment)
 
-        if not renderer_exists(attachment.mimetype) or \
-                not attachment.mimetype.startswith('image/'):
+        # Checked before the file is stored, so refused files aren't kept
+        attachment_type = upload_type(attachment)
+        if not renderer_exists(attachment_type) or \
+                not attachment_type.startswith('image/'):
             abort(400, 'Avatar format unsupported')
 
-        attachment_part = MimePart(
-            type=attachment.mimetype,
-            body=attachment.stream.read(),
-            text_preview=attachment.filename
-        )
-
+        attachment_part = part_from_upload(attachment)
         p.add_part(attachment_part, order=order, inline=True)
         _user.contact.avatar = attachment_part
 
@@ -255,6 +255,7 @@ def edit(_user):
         if old_tags != new_tags:
             changed.append('tags')
             _user.contact.interests = tag_objects
+            FeedEntry.rebuild(user_ids=[_user.id])
 
     p.add_part(
         order=0,
@@ -276,4 +277,8 @@ def edit(_user):
 
     db.session.commit()
 
+    if 'avatar' in changed:
+        make_variants(_user.contact.avatar)
+        db.session.commit()
+
     return redirect(url_for('contacts.profile', contact_id=_user.contact.id))
@@ -0,0 +1,51 @@
+"""
+Generic in-process caching helpers.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """
+    A dict-like cache that holds at most <size> items, discarding the least
+    recently used items first. Hits and misses are counted.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries[key] = value  # Now most-recently used
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def remove_matching(self, match):
+        """
+        Discard every item whose key the function <match> returns true for.
+        """
+        with self.lock:
+            for key in [k for k in self.entries if match(k)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,33 @@
+"""
+Administrative commands that are run from the command line rather than
+through the web interface, such as rebuilding derived tables.
+"""
+from __future__ import absolute_import
+
+COMMANDS = {}
+
+
+def command(name):
+    """
+    Decorator which registers a function as an administrative command that
+    can be invoked by name from the command line.
+    """
+    def _inner(f):
+        COMMANDS[name] = f
+        return f
+    return _inner
+
+
+def run_command(app, args):
+    """
+    Run the command named by the first item in the list <args>, passing the
+    remaining items as arguments. The command runs inside a request context
+    (using the configured SERVER_URL, if any) so that URLs can be generated.
+    """
+    if not args or args[0] not in COMMANDS:
+        raise SystemExit('Available commands: {0}'.format(
+            ', '.join(sorted(COMMANDS.keys()))
+        ))
+
+    with app.test_request_context(base_url=app.config.get('SERVER_URL')):
+        return COMMANDS[args[0]](*args[1:])
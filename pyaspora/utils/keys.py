@@ -0,0 +1,79 @@
+"""
+Cache of parsed RSA keys. Importing a key from PEM text means parsing
+ASN.1 (and, for the private key held in the session, decrypting it), which
+is wasteful to repeat for every message received or request made.
+
+Public keys are cached by Contact ID and a fingerprint of the key text, so a
+changed key is never confused with the old one; entries for a Contact are
+also dropped when its key is changed. The cache size is set with the
+KEY_CACHE_SIZE setting.
+"""
+from __future__ import absolute_import
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from flask import current_app
+
+from pyaspora.utils.cache import LRUCache
+
+DEFAULT_SIZE = 1000
+
+_caches = {}
+
+
+def _cache(name):
+    cache = _caches.get(name, None)
+    if cache is None:
+        cache = _caches[name] = LRUCache(
+            current_app.config.get('KEY_CACHE_SIZE', DEFAULT_SIZE)
+        )
+    return cache
+
+
+def fingerprint(pem):
+    """
+    A digest of the key text <pem>, identifying the key.
+    """
+    if not isinstance(pem, bytes):
+        pem = pem.encode('utf-8')
+    return SHA256.new(pem).hexdigest()
+
+
+def public_key_for(contact):
+    """
+    The parsed RSA public key of Contact <contact>.
+    """
+    if contact.id is None:  # Not saved, so can't be keyed
+        return RSA.importKey(contact.public_key)
+
+    cache = _cache('public')
+    cache_key = (contact.id, fingerprint(contact.public_key))
+    key = cache.get(cache_key)
+    if key is None:
+        key = RSA.importKey(contact.public_key)
+        cache.put(cache_key, key)
+    return key
+
+
+def forget_public_key(contact_id):
+    """
+    Drop any cached public keys of the Contact with ID <contact_id>.
+    """
+    if contact_id is not None and 'public' in _caches:
+        _caches['public'].remove_matching(lambda k: k[0] == contact_id)
+
+
+def unlock_session_key(user_id, pem, passphrase):
+    """
+    The private key of the User with ID <user_id>, which is stored in the
+    session as <pem> encrypted with <passphrase>. Raises ValueError,
+    IndexError or TypeError if the key can't be unlocked, as RSA.importKey
+    does.
+    """
+    cache = _cache('session')
+    cache_key = (user_id, fingerprint(pem), fingerprint(passphrase))
+    key = cache.get(cache_key)
+    if key is None:
+        key = RSA.importKey(pem, passphrase=passphrase)
+        cache.put(cache_key, key)
+    return key
@@ -0,0 +1,101 @@
+"""
+Keyset ("cursor") pagination for feeds of Posts, which are ordered newest
+thread first. Rather than using an offset, each page asks for the items
+older than the last item on the previous page, so every page costs the same
+to fetch.
+"""
+from __future__ import absolute_import
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from dateutil.parser import parse as parse_date
+from flask import current_app, request, url_for
+from json import dumps, loads
+from sqlalchemy.sql import and_, desc, func, or_, select
+
+from pyaspora.utils.rendering import abort
+
+DEFAULT_PAGE_SIZE = 99
+
+# The most items a client may ask for in one page
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(modified_at, post_id):
+    """
+    Turn the sort key of the last item on a page into an opaque string.
+    """
+    key = [modified_at.isoformat() if modified_at else None, post_id]
+    return urlsafe_b64encode(dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor produced by encode_cursor back into a
+    (modified_at, post_id) tuple.
+    """
+    try:
+        modified_at, post_id = loads(
+            urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        )
+        if modified_at:
+            modified_at = parse_date(modified_at)
+        return modified_at, int(post_id)
+    except (BinasciiError, TypeError, ValueError):
+        abort(400, 'Invalid cursor')
+
+
+def paginate(query, modified_column, id_column, key,
+             default_limit=DEFAULT_PAGE_SIZE):
+    """
+    Fetch one page of <query>, ordered by <modified_column> and <id_column>
+    descending and starting after the cursor in the "before" request
+    parameter (if any). <key> is a function that returns the
+    (modified_at, post_id) sort key of an item returned by the query.
+    <modified_column> must not be NULL, so that the order can come straight
+    from an index.
+
+    Returns a tuple of the items on the page and the URL of the next page,
+    which is None if this is the last page. A "limit" parameter larger than
+    MAX_PAGE_SIZE (configurable) is reduced to it.
+    """
+    try:
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        abort(400, 'Invalid limit')
+    if limit < 1:
+        abort(400, 'Invalid limit')
+    limit = min(limit, current_app.config.get('MAX_PAGE_SIZE', MAX_PAGE_SIZE))
+    cursor = request.args.get('before', None)
+
+    if cursor:
+        modified_at, post_id = decode_cursor(cursor)
+        # The time is compared as stored against the cursor item, as a time
+        # passed in can differ from it in precision (SQLite stores func.now()
+        # to the second). The time in the cursor is only used if the item
+        # has gone since.
+        stored = query.filter(id_column == post_id). \
+            with_entities(modified_column.label('modified_at')). \
+            limit(1).subquery()
+        modified_at = func.coalesce(
+            select([stored.c.modified_at]).as_scalar(),
+            modified_at
+        )
+        query = query.filter(or_(
+            modified_column < modified_at,
+            and_(modified_column == modified_at, id_column < post_id)
+        ))
+
+    # Fetch one extra to find out if there's another page
+    items = query.order_by(
+        desc(modified_column),
+        desc(id_column)
+    ).limit(limit + 1).all()
+    if len(items) <= limit:
+        return items, None
+
+    items = items[:limit]
+    args = request.args.to_dict()
+    args.update(request.view_args or {})
+    args['before'] = encode_cursor(*key(items[-1]))
+    return items, url_for(request.endpoint, _external=True, **args)
@@ -1,13 +1,17 @@
 from __future__ import absolute_import
 
 from dateutil.tz import tzlocal, tzutc
-from flask import jsonify, make_response, render_template, request, url_for, \
-    abort as flask_abort, redirect as flask_redirect
+from flask import current_app, jsonify, make_response, render_template, \
+    request, url_for, abort as flask_abort, redirect as flask_redirect
 from lxml import etree
 
 
 ACCEPTABLE_BROWSER_IMAGE_FORMATS = ('image/jpeg', 'image/gif', 'image/png')
 
+# Parts never change, so can be cached for as long as a client likes
+CACHE_FOREVER = 365 * 24 * 60 * 60
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def _desired_format(default='html'):
     return request.args.get('alt', 'html')
@@ -19,6 +23,120 @@ def raw_response(body, mime_type):
     return response
 
 
+class _PartStream(object):
+    """
+    Response body that reads <length> bytes from <fileobj>, starting at
+    <start>, a chunk at a time, and closes the file when the response is
+    finished with.
+    """
+
+    def __init__(self, fileobj, start, length):
+        self.fileobj = fileobj
+        self.start = start
+        self.length = length
+
+    def __iter__(self):
+        self.fileobj.seek(self.start)
+        remaining = self.length
+        while remaining > 0:
+            chunk = self.fileobj.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _byte_range(size):
+    """
+    Work out the part of a body of <size> bytes asked for by the request's
+    Range header, as a (start, end) tuple with <end> exclusive. Returns None
+    if the whole body should be sent (including for multiple ranges, which
+    aren't supported), or False if the range can't be satisfied.
+    """
+    header = request.headers.get('Range', '')
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    try:
+        if not start:
+            # The last <end> bytes
+            if not int(end):
+                return False
+            return max(0, size - int(end)), size
+        start = int(start)
+        end = int(end) + 1 if end else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        return False
+    return start, min(end, size)
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified:
+        since = request.if_modified_since
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=tzutc())  # HTTP dates are in GMT
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+def send_part(part, max_age=0, public=False):
+    """
+    Return the body of MimePart <part>, streamed a chunk at a time, with
+    headers that let it be cached for <max_age> seconds (0 meaning that it
+    must be revalidated each time), and by shared caches if <public> is
+    true. Requests for a byte range are honoured, and conditional requests
+    are answered without reading the body.
+    """
+    etag = part.body_hash or 'part-{0}'.format(part.id)
+    last_modified = ensure_timezone(part.created_at) \
+        if part.created_at else None
+
+    response = current_app.response_class(direct_passthrough=True)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    response.headers['Accept-Ranges'] = 'bytes'
+
+    if _not_modified(etag, last_modified):
+        response.status_code = 304
+        return response
+
+    size = part.body_size()
+    byte_range = None
+    if 'If-Range' not in request.headers or \
+            request.headers['If-Range'] == response.headers['ETag']:
+        byte_range = _byte_range(size)
+    if byte_range is False:
+        response.status_code = 416
+        response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+        return response
+
+    start, end = byte_range or (0, size)
+    if byte_range:
+        response.status_code = 206
+        response.headers['Content-Range'] = \
+            'bytes {0}-{1}/{2}'.format(start, end - 1, size)
+    response.headers['Content-Type'] = part.type
+    response.headers['Content-Length'] = str(end - start)
+    response.response = _PartStream(part.open_body(), start, end - start)
+    return response
+
+
 def render_response(template_name, data_structure=None, output_format=None):
     """
     If the original request was for JSON, return the JSON data structure. If
@@ -0,0 +1,52 @@
+"""
+Helpers for doing slow work (mostly fetching from other servers) in
+parallel.
+"""
+from __future__ import absolute_import
+
+from flask import current_app
+from threading import Thread
+try:
+    from queue import Empty, Queue
+except:
+    from Queue import Empty, Queue
+
+
+def map_in_threads(fn, items, workers):
+    """
+    Call <fn> on each of <items> using up to <workers> threads, and return a
+    dict mapping each item to a tuple of (result, exception), one of which
+    will be None. The threads run in the current app's context but must not
+    use the database session, which is not shared between threads.
+    """
+    items = list(items)
+    results = {}
+    if not items:
+        return results
+
+    todo = Queue()
+    for item in items:
+        todo.put(item)
+    app = current_app._get_current_object()
+
+    def _worker():
+        with app.app_context():
+            while True:
+                try:
+                    item = todo.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results[item] = (fn(item), None)
+                except Exception as e:
+                    results[item] = (None, e)
+
+    threads = [
+        Thread(target=_worker)
+        for i in range(max(1, min(workers, len(items))))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
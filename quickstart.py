@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+from sys import argv
+
 from pyaspora import app
+from pyaspora.utils.commands import run_command
 
 # Command to generate random string:
 # python -c 'import os; import base64; print(base64.b64encode(os.urandom(32)))'
@@ -14,8 +17,17 @@ app.config['SMTP_URL'] = None  # 'smtp://smtp.example.com/'
 # You can change the database used here
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../database.sqlite'
 
-# This controls where uploaded files are placed temporarily
+# This controls where uploaded files are placed temporarily, and how big
+# (in bytes) an uploaded file may be
 app.config['UPLOAD_FOLDER'] = '/tmp'
+app.config['UPLOAD_MAX_BYTES'] = 16 * 1024 * 1024
+
+# Where the content of posts and pictures is stored
+app.config['BLOB_STORE'] = 'filesystem'
+app.config['BLOB_STORE_PATH'] = '../blobs'
+
+# The most posts that may be asked for in one page of a feed
+app.config['MAX_PAGE_SIZE'] = 200
 
 # Whether to allow new-user signup
 app.config['ALLOW_CREATION'] = False
@@ -23,7 +35,65 @@ app.config['ALLOW_CREATION'] = False
 # Whether to permit user download from HTTP (not HTTPS)
 app.config['ALLOW_INSECURE_HOSTMETA'] = False
 
+# How long (in seconds) to keep the documents fetched to look up users on
+# other servers, how long to remember that a lookup failed, and for how long
+# after expiry a document may still be used whilst it's re-fetched
+app.config['DISCOVERY_TTL'] = 24 * 60 * 60
+app.config['DISCOVERY_FAILURE_TTL'] = 10 * 60
+app.config['DISCOVERY_STALE_TTL'] = 7 * 24 * 60 * 60
+
+# How many remote users' details are fetched at once when importing contacts
+# in bulk (by the import_contacts command and the incoming message worker)
+app.config['IMPORT_WORKERS'] = 8
+
+# Remote contacts' pictures are downloaded by the incoming message worker.
+# Larger pictures (in bytes) are refused, and failed downloads are retried
+# this many times.
+app.config['AVATAR_MAX_BYTES'] = 256 * 1024
+app.config['AVATAR_MAX_ATTEMPTS'] = 3
+
+# Rendered posts are cached in memory (this many items). They can also be
+# stored in the database so they survive restarts.
+app.config['RENDER_CACHE_SIZE'] = 1000
+app.config['RENDER_CACHE_PERSIST'] = False
+
+# Number of parsed RSA keys (contacts' public keys and logged-in users'
+# private keys) to keep in memory
+app.config['KEY_CACHE_SIZE'] = 1000
+
+# Messages to other servers are queued and delivered by a separate worker
+# (run "./quickstart.py deliver_outgoing"), using this many threads, and at
+# most this many connections to any one server
+app.config['OUTGOING_WORKERS'] = 4
+app.config['OUTGOING_HOST_CONNECTIONS'] = 2
+
+# Messages from other servers are processed by a separate worker (run
+# "./quickstart.py process_incoming"). Private messages can only be processed
+# there if users' private keys are kept in escrow, protected by the passphrase
+# below (or the secret key if not set) rather than by their passwords. Keys
+# are escrowed when users next log in. Otherwise users process their own
+# messages when they log in.
+app.config['KEY_ESCROW'] = False
+app.config['KEY_ESCROW_PASSPHRASE'] = None
+
+# Public messages from different senders are processed in parallel by this
+# many threads. Messages that fail this many times are set aside (run
+# "./quickstart.py requeue_failed_public" to retry them).
+app.config['INCOMING_WORKERS'] = 4
+app.config['INCOMING_MAX_ATTEMPTS'] = 3
+
+# Messages from other servers larger than this (in bytes) are refused
+app.config['INCOMING_MAX_BYTES'] = 1024 * 1024
+
+# The external URL of this node, used when running commands (and background
+# workers) outside of a web request
+app.config['SERVER_URL'] = None  # 'http://localhost:5000/'
+
 assert app.secret_key, \
     'You need to edit quickstart.py to configure the application'
 
-app.run(debug=True)
+if len(argv) > 1:
+    # eg. ./quickstart.py rebuild_feeds
+    run_command(app, argv[1:])
+else:
+    app.run(debug=True)